@@ -0,0 +1,238 @@
+#!path/to/python
+""" A stand-in for OpenClinica, to benchmark the backends against
+
+    It serves just enough of the pages the tool uses: the login page,
+    Change Study, ViewRuleAssignment and TestRule. TestRule computes
+    whether the actions fire with the offline evaluator (expression.py).
+    Every request waits 'latency' seconds, and a fraction 'failures' of the
+    TestRule requests gets a 503, to exercise the retries.
+"""
+import os
+import sys
+import time
+import random
+import urlparse
+import threading
+import SocketServer
+import BaseHTTPServer
+from cgi import escape
+
+# the rule expression evaluator lives in the main folder
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from expression import compile_expression, Unsupported
+
+PREFIX = "/OpenClinica/"
+
+PAGE = "<html><body>%s</body></html>"
+
+LOGIN = """<form action="j_spring_security_check" method="post">
+<input type="text" id="username" name="j_username">
+<input type="password" id="password" name="j_password">
+<input type="submit" name="submit" value="Login">
+</form>"""
+
+MAIN = """<div id="StudyInfo"><b><a href="ViewStudy">%s</a></b></div>
+<a href="ChangeStudy">Change Study/Site</a>"""
+
+STUDIES = """<form action="ChangeStudy" method="post"><table>%s</table>
+<input type="submit" name="Submit" value="Continue"></form>"""
+
+STUDY = """<tr><td><input type="radio" name="studyId" value="%d"><b>%s</b></td></tr>"""
+
+CONFIRM = """<form action="ChangeStudy" method="post">
+<input type="hidden" name="action" value="confirm">
+<input type="hidden" name="studyId" value="%s">
+<input type="submit" name="Submit" value="Confirm"></form>"""
+
+ASSIGNMENTS = """<table><tr><td>%s</td>
+<td><a href="ViewRuleSet?ruleName=%s">View</a></td>
+<td><a href="TestRule?ruleName=%s&amp;action=view">Test</a></td>
+<td><a href="TestRule?ruleName=%s&amp;action=edit">Test</a></td></tr></table>"""
+
+TESTRULE = """<form action="TestRule" method="post">
+<input type="hidden" name="ruleName" value="%s">
+<table>%s</table>
+<input type="submit" name="submit" value="Validate &amp; Test">
+</form>%s"""
+
+ITEM = """<tr><td>%s</td><td><input type="text" id="%s" name="%s" value="%s"></td></tr>"""
+
+RESULT = """<table><tr><td>Rule Expression Result</td><td>%s</td></tr>
+<tr><td>Actions Fired</td><td>%s</td></tr></table>"""
+
+
+class FakeOpenClinica(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """ The server: rules, studies, sessions and request counters """
+    daemon_threads = True
+
+    def __init__(self, rules, studies, user, password, latency, failures, port=0):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', port), Handler)
+        # rule expressions by rule name
+        self.rules = rules
+        self.studies = studies
+        self.user = user
+        self.password = password
+        self.latency = latency
+        self.failures = failures
+        # current study per session cookie
+        self.sessions = {}
+        self.requests = 0
+        self.failed = 0
+        self.lock = threading.Lock()
+        self.url = "http://127.0.0.1:%d%s" % (self.server_address[1], PREFIX)
+
+    def outcome(self, rule_name, values):
+        """ 'Y' if the actions of the rule fire for these values, else 'N' """
+        try:
+            fires = compile_expression(self.rules[rule_name]).evaluate(values)
+        except Unsupported:
+            fires = False
+        return 'Y' if fires else 'N'
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # send every response in one piece, or the kept-alive connections
+    # add delayed acknowledgements to the latency
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.handle_page({})
+
+    def do_POST(self):
+        length = int(self.headers.getheader('content-length') or 0)
+        self.handle_page(urlparse.parse_qs(self.rfile.read(length)))
+
+    def handle_page(self, form):
+        server = self.server
+        with server.lock:
+            server.requests += 1
+        if server.latency:
+            time.sleep(server.latency * random.uniform(0.5, 1.5))
+        url = urlparse.urlparse(self.path)
+        page = url.path[len(PREFIX):] if url.path.startswith(PREFIX) else url.path
+        # the tool builds some urls with spaces around the parameters
+        query = dict((key.strip(), values[-1])
+                     for key, values in urlparse.parse_qs(url.query).items())
+        query.update((key, values[-1]) for key, values in form.items())
+        session = self.session()
+
+        if page == 'j_spring_security_check':
+            if query.get('j_username') == server.user and \
+                    query.get('j_password') == server.password:
+                session = "%016x" % random.getrandbits(64)
+                server.sessions[session] = server.studies[-1]
+                return self.reply(MAIN % escape(server.sessions[session]), session)
+            return self.reply(LOGIN)
+        if session is None:
+            return self.reply(LOGIN)
+        if page == 'ChangeStudy':
+            return self.change_study(session, query)
+        if page == 'ViewRuleAssignment':
+            name = query.get('ruleAssignments_f_ruleName', '').strip()
+            if name not in server.rules:
+                return self.reply("<table></table>")
+            return self.reply(ASSIGNMENTS % ((escape(name, True),) * 4))
+        if page == 'TestRule':
+            return self.test_rule(query)
+        return self.reply(MAIN % escape(server.sessions[session]))
+
+    def session(self):
+        """ The session cookie of a logged in client, None if there is none """
+        for part in (self.headers.getheader('cookie') or '').split(';'):
+            name, _, value = part.strip().partition('=')
+            if name == 'JSESSIONID' and value in self.server.sessions:
+                return value
+        return None
+
+    def change_study(self, session, query):
+        server = self.server
+        if 'studyId' not in query:
+            rows = "".join(STUDY % (number, escape(study))
+                           for number, study in enumerate(server.studies))
+            return self.reply(STUDIES % rows)
+        if query.get('action') != 'confirm':
+            return self.reply(CONFIRM % escape(query['studyId'], True))
+        server.sessions[session] = server.studies[int(query['studyId'])]
+        return self.reply(MAIN % escape(server.sessions[session]))
+
+    def test_rule(self, query):
+        server = self.server
+        if random.random() < server.failures:
+            with server.lock:
+                server.failed += 1
+            return self.reply("Service Unavailable", status=503)
+        name = query.get('ruleName', '')
+        if name not in server.rules:
+            return self.reply("<p>Rule not found</p>")
+        if self.command == 'GET':
+            return self.reply(TESTRULE % (escape(name, True), "", ""))
+        expression = compile_expression(server.rules[name])
+        values = dict((item, query.get(item, '')) for item in expression.items)
+        rows = "".join(ITEM % (escape(item), escape(item, True), escape(item, True),
+                               escape(values[item], True))
+                       for item in expression.items)
+        result = ""
+        if any(item in query for item in expression.items):
+            outcome = server.outcome(name, values)
+            result = RESULT % (outcome == 'Y', outcome)
+        return self.reply(TESTRULE % (escape(name, True), rows, result))
+
+    def reply(self, body, session=None, status=200):
+        body = PAGE % body
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        if session is not None:
+            self.send_header('Set-Cookie', 'JSESSIONID=%s; Path=/' % session)
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def start(rules, study="STUDY", user="USER", password="PASSWORD",
+          latency=0.0, failures=0.0, port=0):
+    """ Start a fake OpenClinica in a background thread
+
+        'rules' holds the rule expressions by rule name. Sessions start in
+        another study than 'study', so set_study has to change it.
+        Returns the server; its url is in server.url, stop it with
+        server.shutdown().
+    """
+    server = FakeOpenClinica(rules, [study, "OTHER STUDY"], user, password,
+                             latency, failures, port)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+if __name__ == "__main__":
+    import argparse
+    from readers import find_script
+    from models import read_script
+
+    parser = argparse.ArgumentParser(description="A fake OpenClinica for the rules in test scripts")
+    parser.add_argument('scripts', nargs='+', help="test scripts with the rules to serve")
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help="average seconds every request takes")
+    parser.add_argument('--failures', type=float, default=0.0,
+                        help="fraction of the TestRule requests that fail with a 503")
+    args = parser.parse_args()
+
+    rules = {}
+    for script in args.scripts:
+        for rule in read_script(find_script(os.getcwd(), script) or script):
+            rules[rule.name] = rule.expression
+    server = start(rules, latency=args.latency, failures=args.failures, port=args.port)
+    print "Serving %d rules at %s (user USER, password PASSWORD, study STUDY)" % (
+            len(rules), server.url)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
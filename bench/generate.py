@@ -0,0 +1,91 @@
+#!path/to/python
+""" Synthetic test scripts for the benchmarks
+
+    A script has N rules with M tests each, and every test fills in K items.
+    The rules compare the sum of their items with a threshold, so the
+    expected outcome of every test is known, and the fake OpenClinica
+    server (fake_oc.py) can compute the same outcome.
+"""
+import os
+import csv
+import sys
+import random
+
+HEADER = ["Test ID", "Rule Name", "Rule Message", "Rule Expression",
+          "Expected Result"]
+
+
+def synthetic_rules(rules, tests, items, seed=0, prefix="R"):
+    """ Rows of a synthetic script: one list of cell values per test """
+    generator = random.Random(seed)
+    rows = []
+    for r in range(rules):
+        name = "%s%04d" % (prefix, r)
+        keys = ["I_%s_%02d" % (name, k) for k in range(items)]
+        threshold = 5 * items
+        expression = "%s gt %d" % (" + ".join(keys), threshold)
+        for t in range(tests):
+            values = [generator.randint(0, 10) for _ in keys]
+            expected = "Fires" if sum(values) > threshold else "FiresNot"
+            row = ["%s_%03d" % (name, t), name, "Check %s" % name, expression, expected]
+            for key, value in zip(keys, values):
+                row.extend([key, float(value)])
+            rows.append(row)
+    return rows
+
+
+def write_csv(filename, rows):
+    with open(filename, 'wb') as f:
+        writer = csv.writer(f)
+        writer.writerow(HEADER)
+        for row in rows:
+            writer.writerow([unicode(value).encode('utf-8') for value in row])
+
+
+def write_xls(filename, rows):
+    import xlwt
+    book = xlwt.Workbook()
+    sheet = book.add_sheet("Tests")
+    for column, label in enumerate(HEADER):
+        sheet.write(0, column, label)
+    for number, row in enumerate(rows):
+        for column, value in enumerate(row):
+            sheet.write(number + 1, column, value)
+    book.save(filename)
+
+
+def write_xlsx(filename, rows):
+    import openpyxl
+    book = openpyxl.Workbook(write_only=True)
+    sheet = book.create_sheet("Tests")
+    sheet.append(HEADER)
+    for row in rows:
+        sheet.append(row)
+    book.save(filename)
+
+
+# Writer per file extension, like the readers in readers.py
+WRITERS = {'.csv': write_csv,
+           '.xls': write_xls,
+           '.xlsx': write_xlsx}
+
+
+def write_script(filename, rules, tests, items, seed=0):
+    """ Write a synthetic script, in the format that goes with its extension
+
+        Returns the rule expressions by rule name.
+    """
+    rows = synthetic_rules(rules, tests, items, seed)
+    WRITERS[os.path.splitext(filename)[1].lower()](filename, rows)
+    return dict((row[1], row[3]) for row in rows)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 5:
+        print "Usage: generate.py SCRIPT RULES TESTS ITEMS"
+        print "       SCRIPT is a .csv, .xls or .xlsx file"
+        sys.exit(1)
+    filename = sys.argv[1]
+    rules, tests, items = [int(arg) for arg in sys.argv[2:]]
+    write_script(filename, rules, tests, items)
+    print "%s: %d rules, %d tests" % (filename, rules, rules * tests)
@@ -0,0 +1,191 @@
+#!path/to/python
+""" Benchmarks of script loading, test execution and report generation
+
+    The backends run against the fake OpenClinica in fake_oc.py, with
+    synthetic scripts from generate.py. Results are written as JSON, so
+    runs of different releases can be compared. settings.py is used as
+    for a normal run, except for the OpenClinica instance.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+from contextlib import contextmanager
+
+# the tool lives in the main folder
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from models import TestBattery
+from cache import ScriptCache
+import timings
+
+import fake_oc
+from generate import write_script
+
+RESULTS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+
+
+@contextmanager
+def quiet():
+    """ Silence the progress output of the tool """
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        yield
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+
+def timed(function, *args):
+    """ Seconds a call takes, and what it returns """
+    start = time.time()
+    result = function(*args)
+    return time.time() - start, result
+
+
+def bench_loading(folder, args):
+    """ Parse a script per format, without and with the script cache """
+    results = []
+    for extension in ('.csv', '.xls', '.xlsx'):
+        page = "LOAD%s" % extension.replace('.', '_').upper()
+        write_script(os.path.join(folder, page + extension),
+                     args.rules, args.tests, args.items)
+        rows = args.rules * args.tests
+        parsed = ScriptCache(os.path.join(folder, "parsed"))
+        for mode, cache in (('parse', None), ('cold cache', parsed), ('warm cache', parsed)):
+            seconds, battery = timed(TestBattery, folder, [page + extension], False, cache)
+            results.append({'benchmark': 'load', 'format': extension[1:], 'mode': mode,
+                            'rows': rows, 'seconds': seconds,
+                            'ms_per_1000_rows': seconds * 1000000.0 / rows})
+    return results
+
+
+def create_backend(name, url, folder, args):
+    """ A fresh session of a backend, without the forms cached by earlier ones """
+    if name == 'selenium':
+        from browser import Browser
+        return Browser(url, folder)
+    from httpbrowser import HttpBrowser
+    HttpBrowser.rule_urls.clear()
+    HttpBrowser.forms.clear()
+    if name == 'http':
+        browser = HttpBrowser(url, folder)
+        browser.retries, browser.backoff = 3, 0.05
+        return browser
+    from engine import ConcurrentEngine
+    return ConcurrentEngine(url, folder, args.workers, args.rate, args.workers,
+                            retries=3, backoff=0.05)
+
+
+def bench_backend(name, script, server, folder, args):
+    """ Login, set_study and the run of all tests with one backend """
+    screenshots = os.path.join(folder, "screenshots_%s" % name)
+    os.mkdir(screenshots)
+    result = {'benchmark': 'execute', 'backend': name}
+    try:
+        with quiet():
+            result['start_seconds'], browser = timed(create_backend, name, server.url,
+                                                     screenshots, args)
+            result['login_seconds'], _ = timed(browser.login, server.user, server.password)
+            result['set_study_seconds'], _ = timed(browser.set_study, server.studies[0])
+            battery = TestBattery(os.path.dirname(script), [os.path.basename(script)])
+            result['validate_seconds'], _ = timed(battery.validate, browser)
+            browser.close()
+    except Exception as e:
+        result['error'] = "%s: %s" % (e.__class__.__name__, e)
+        return result, None
+    totals = battery.summary()[1]
+    result['tests'] = totals['tests']
+    result['passed_tests'] = totals['passed_tests']
+    result['tests_per_second'] = totals['tests'] / result['validate_seconds']
+    result['ms_per_test'] = result['validate_seconds'] * 1000.0 / totals['tests']
+    result['phases'] = timings.per_phase(battery.spans())
+    return result, battery
+
+
+def bench_reports(battery, folder):
+    """ Render all reports, then again with every report unchanged,
+        per rule and merged per page
+    """
+    results = []
+    for merged in (False, True):
+        root = os.path.join(folder, "merged" if merged else "reports")
+        for number, mode in enumerate(('new', 'unchanged')):
+            path = os.path.join(root, "run%d" % number)
+            with quiet():
+                seconds, _ = timed(battery.create_reports, path, None, merged)
+            files = sum(len(names) for _, _, names in os.walk(path))
+            results.append({'benchmark': 'reports', 'mode': mode, 'merged': merged,
+                            'rules': battery.summary()[1]['rules'], 'files': files,
+                            'seconds': seconds})
+    return results
+
+
+def main(args):
+    folder = tempfile.mkdtemp(prefix="oc_bench_")
+    results = []
+    try:
+        results.extend(bench_loading(folder, args))
+
+        script = os.path.join(folder, "EXECUTE.csv")
+        rules = write_script(script, args.exec_rules, args.tests, args.items)
+        server = fake_oc.start(rules, latency=args.latency, failures=args.failures)
+        battery = None
+        try:
+            for name in args.backends:
+                result, validated = bench_backend(name, script, server, folder, args)
+                result['requests'], result['failed_requests'] = server.requests, server.failed
+                server.requests = server.failed = 0
+                results.append(result)
+                battery = battery or validated
+        finally:
+            server.shutdown()
+        if battery is not None:
+            results.extend(bench_reports(battery, folder))
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks of the rules validation tool")
+    parser.add_argument('--rules', type=int, default=200,
+                        help="rules per script in the loading benchmark")
+    parser.add_argument('--exec-rules', type=int, default=10,
+                        help="rules per script in the execution benchmarks")
+    parser.add_argument('--tests', type=int, default=5, help="tests per rule")
+    parser.add_argument('--items', type=int, default=3, help="items per test")
+    parser.add_argument('--backends', nargs='+', default=['http', 'concurrent'],
+                        choices=['selenium', 'http', 'concurrent'])
+    parser.add_argument('--workers', type=int, default=4,
+                        help="sessions of the concurrent backend")
+    parser.add_argument('--rate', type=float, default=1000,
+                        help="requests per second of the concurrent backend")
+    parser.add_argument('--latency', type=float, default=0.01,
+                        help="average seconds the fake server takes per request")
+    parser.add_argument('--failures', type=float, default=0.0,
+                        help="fraction of TestRule requests that fail with a 503")
+    parser.add_argument('--output',
+                        help="JSON file for the results (default: results/<date>.json)")
+    args = parser.parse_args()
+
+    results = main(args)
+    report = {'date': time.strftime("%Y-%m-%d %H:%M:%S"),
+              'python': platform.python_version(),
+              'platform': platform.platform(),
+              'parameters': vars(args),
+              'results': results}
+    output = args.output
+    if output is None:
+        if not os.path.isdir(RESULTS):
+            os.makedirs(RESULTS)
+        output = os.path.join(RESULTS, "%s.json" % time.strftime("%Y_%m_%d_%H_%M_%S"))
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=1, sort_keys=True)
+    for result in results:
+        print json.dumps(result, sort_keys=True)
+    print "Results written to %s" % output
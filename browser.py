@@ -0,0 +1,208 @@
+import os
+
+from selenium import webdriver
+from selenium.webdriver.common.by import By
+from selenium.webdriver.common.keys import Keys
+from selenium.webdriver.support import expected_conditions as EC
+from selenium.webdriver.support.ui import WebDriverWait
+from selenium.common.exceptions import NoSuchElementException, TimeoutException
+from pyvirtualdisplay import Display
+
+import screenshots
+from models import BaseBrowser, LoginError, format_value
+from config import WAITS, SCREENSHOTS
+
+
+class Browser(BaseBrowser):
+    """ Holds a selenium Firefox browser session for testing
+
+        There is no implicit wait on the session. Elements that must be
+        on the page are waited for up to WAITS['PRESENT'] seconds, elements
+        that may legitimately be missing (an unknown rule, a wrong item id)
+        only up to WAITS['ABSENT'] seconds.
+    """
+    # TestRule url per rule name, shared by all browser sessions
+    rule_urls = {}
+
+    def __init__(self, url, path):
+        """ Starts a browser session with the
+            OpenClinica instance defined in 'url'
+        """
+        BaseBrowser.__init__(self, url, path)
+        self.start()
+
+    def start(self):
+        """ Start a virtual display (on Linux) and Firefox """
+        if os.uname()[0] == 'Linux':
+            self.display = Display(visible=0, size=(800, 600))
+            self.display.start()
+        self.session = webdriver.Firefox()
+
+    def wait_for(self, by, locator, timeout=None):
+        """ Wait until an element is present and return it """
+        if timeout is None:
+            timeout = WAITS['PRESENT']
+        return WebDriverWait(self.session, timeout).until(
+                EC.presence_of_element_located((by, locator)))
+
+    def find_optional(self, by, locator):
+        """ Look up an element that may be absent.
+
+            Gives up after WAITS['ABSENT'] seconds and returns None.
+        """
+        try:
+            return self.wait_for(by, locator, WAITS['ABSENT'])
+        except TimeoutException:
+            return None
+
+    def submit(self):
+        """ Click 'Validate & Test' and wait for the next page """
+        button = self.wait_for(By.XPATH, "//input[@value='Validate & Test']")
+        button.click()
+        WebDriverWait(self.session, WAITS['PRESENT']).until(EC.staleness_of(button))
+
+    def login(self, user, password):
+        """ Login to the OpenClinica instance, raises LoginError if that fails """
+        self.credentials = (user, password)
+        try:
+            self.session.get(self.url)
+            self.wait_for(By.NAME, "j_username").send_keys(user)
+            self.wait_for(By.NAME, "j_password").send_keys(password)
+            self.wait_for(By.NAME, "submit").click()
+        except Exception as e:
+            raise LoginError("Unable to log in: %s" % e)
+
+    def set_study(self, study):
+        """ Change (if needed) to the study we want to use
+
+            Raises LoginError if the study is not found.
+        """
+        self.study = study
+        # first see if we are already at the right study
+        xpath_expr = "//div[@id='StudyInfo']/b/a"
+        try:
+            elem = self.wait_for(By.XPATH, xpath_expr)
+        except TimeoutException:
+            raise LoginError("Not logged in")
+        # if not, change the study
+        if elem.text != study:
+            self.wait_for(By.LINK_TEXT, 'Change Study/Site').click()
+            try:
+                xpath_expr = "//td/b[contains(text(),'%s')]/../input[@name='studyId']" % study
+                self.wait_for(By.XPATH, xpath_expr).click()
+                self.wait_for(By.XPATH, xpath_expr).click()
+                self.wait_for(By.NAME, "Submit").click()
+                self.wait_for(By.NAME, "Submit").click()
+            except (NoSuchElementException, TimeoutException):
+                raise LoginError("Study %s not found" % study)
+
+    def alive(self):
+        """ Check that Firefox still responds, and has not been logged out """
+        try:
+            return not self.session.find_elements_by_name("j_username")
+        except Exception:
+            return False
+
+    def close(self):
+        """ Close browser and display """
+        self.session.close()
+        if os.uname()[0] == 'Linux':
+            self.display.stop()
+
+    def open_rule(self, rule_name):
+        """ Navigate to the TestRule form of a rule
+
+            The TestRule url is looked up on the ViewRuleAssignment page
+            the first time, and cached per rule name after that.
+            Returns True if the form could be opened.
+        """
+        self.rule = None
+        self.filled = set()
+        try:
+            url = Browser.rule_urls.get(rule_name)
+            if url is None:
+                with self.phase('rule_page'):
+                    self.session.get(self.rule_page(rule_name))
+                    # the page has loaded, so a missing rule has no links
+                    test_button = self.session.find_elements_by_xpath(
+                            "//a[contains(@href, 'TestRule')]")
+                    url = test_button[1].get_attribute('href')
+                    Browser.rule_urls[rule_name] = url
+            with self.phase('open'):
+                self.session.get(url)
+                self.submit()
+        except:
+            return False
+        self.rule = rule_name
+        return True
+
+    def capture(self, filename, element=None):
+        """ Save a screenshot, and pass it through the screenshot pipeline
+
+            If 'element' is given, the image is cropped to the table that
+            holds it. Returns the path of the processed image, or ''
+            if there is no screenshot (Firefox has crashed).
+        """
+        try:
+            if not self.session.save_screenshot(filename):
+                return ''
+        except Exception:
+            return ''
+        box = None
+        if element is not None and SCREENSHOTS['CROP']:
+            try:
+                table = element.find_element_by_xpath("ancestor::table[1]")
+                x, y = table.location['x'], table.location['y']
+                box = (x, y, x + table.size['width'], y + table.size['height'])
+            except:
+                pass
+        return screenshots.process(filename, box)
+
+    def _run_test(self, test):
+        """ Fill in and submit the TestRule form for one test """
+        screenshot = '%s/screenshot_%s.png' % (self.screenshot_path, test.test_id)
+        # test if rule is found
+        if self.rule != test.rule and not self.open_rule(test.rule):
+            return 'Undef', self.capture(screenshot)
+        with self.phase('fill'):
+            # Clear items that were filled in by the previous test
+            # but are not used by this one
+            for k in self.filled - set(test.test_values):
+                elem = self.find_optional(By.ID, k)
+                if elem is not None:
+                    elem.clear()
+            self.filled = set()
+            # Write values to test items
+            for k, v in test.test_values.items():
+                elem = self.find_optional(By.ID, k)
+                if elem is None:
+                    self.rule = None
+                    return 'Undef', self.capture(screenshot)
+                try:
+                    elem.clear()
+                    elem.send_keys(format_value(v))
+                    self.filled.add(k)
+                except:
+                    self.rule = None
+                    return 'Undef', self.capture(screenshot)
+        try:
+            with self.phase('submit'):
+                self.submit()
+            with self.phase('result'):
+                action = self.find_optional(By.XPATH,
+                        "//*[contains(text(), 'Actions Fired')]/following-sibling::td")
+
+                if action is None:
+                    result = "Undef"
+                elif action.text == 'N':
+                    result = "FiresNot"
+                elif action.text == 'Y':
+                    result = "Fires"
+                else:
+                    result = "Undef"
+            with self.phase('screenshot'):
+                screenshot = self.capture(screenshot, action)
+        except:
+            self.rule = None
+            return 'Undef', self.capture(screenshot)
+        return (result, screenshot)
@@ -0,0 +1,178 @@
+import os
+import time
+import hashlib
+import sqlite3
+import cPickle
+
+
+def test_key(rule, test):
+    """ Hash of the definition of a test """
+    definition = repr((rule.name, rule.expression,
+                       sorted(test.test_values.items()),
+                       test.expected_outcome))
+    return hashlib.sha1(definition).hexdigest()
+
+
+class ResultCache(object):
+    """ Outcomes of earlier runs, stored in a SQLite database
+
+        A result is found back by a hash of everything that determines it:
+        the rule name and expression, and the values and expected outcome
+        of the test. When any of these change, the test is run again.
+    """
+    def __init__(self, filename):
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        self.db.execute("""CREATE TABLE IF NOT EXISTS results (
+                               key TEXT PRIMARY KEY,
+                               outcome TEXT,
+                               screenshot TEXT,
+                               stamp REAL)""")
+        self.db.commit()
+
+    def key(self, rule, test):
+        """ Hash of the definition of a test """
+        return test_key(rule, test)
+
+    def restore(self, rules, max_age=None):
+        """ Give tests that have not changed their earlier outcome
+
+            Results older than 'max_age' hours, and results whose
+            screenshot has gone, are not used.
+            Returns the number of tests that do not need to run.
+        """
+        restored = 0
+        for rule in self.restoring(rules, max_age):
+            restored += len(rule.tests) - len(rule.pending_tests())
+        return restored
+
+    def restoring(self, rules, max_age=None):
+        """ Pass on 'rules', after giving their unchanged tests the earlier outcome
+
+            Like restore, but one rule at a time, so 'rules' can be
+            a stream of rules that are still being read.
+        """
+        oldest = time.time() - max_age * 3600 if max_age is not None else 0
+        for rule in rules:
+            for test in rule.tests:
+                if test.cached:
+                    # restored already, from the journal of a resumed run
+                    continue
+                row = self.db.execute("SELECT outcome, screenshot, stamp FROM results "
+                                      "WHERE key = ?", (self.key(rule, test),)).fetchone()
+                if row is None:
+                    continue
+                outcome, screenshot, stamp = row
+                if stamp < oldest or (screenshot and not os.path.exists(screenshot)):
+                    continue
+                test.outcome, test.screenshot, test.cached = outcome, screenshot, stamp
+            yield rule
+
+    def save(self, rules):
+        """ Store the outcomes of the tests of these rules
+
+            Undefined outcomes are not stored, they may be caused by
+            a time-out or a hiccup of the server. Neither are outcomes
+            that were computed offline. Outcomes of earlier runs (from
+            this cache, or the journal of a resumed run) keep their time.
+        """
+        now = time.time()
+        rows = [(self.key(rule, test), test.outcome, test.screenshot, test.cached or now)
+                for rule in rules for test in rule.tests
+                if not test.offline and test.outcome in ("Fires", "FiresNot")]
+        self.db.executemany("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)", rows)
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+
+# Version of the way scripts are read; cache files of other versions are
+# parsed again. 2: xlsx values converted like xls values (readers.xlsx_value),
+# 3: rules know when their actions fire (Rule.fires_when), 4: tests know
+# whether their expected outcome was generated (Test.generated)
+SCRIPTS_FORMAT = 4
+
+
+class ScriptCache(object):
+    """ Parsed test scripts, pickled per script in a folder
+
+        A script is parsed again when its size or modification time
+        has changed, unless its content hash is still the same (for
+        instance after a checkout or a copy).
+    """
+    def __init__(self, folder):
+        self.folder = folder
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+
+    def cache_file(self, filename):
+        return os.path.join(self.folder, os.path.basename(filename) + ".pickle")
+
+    def digest(self, filename):
+        """ sha1 of the content of a file """
+        sha1 = hashlib.sha1()
+        with open(filename, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 16), ''):
+                sha1.update(block)
+        return sha1.hexdigest()
+
+    def load(self, filename, parse):
+        """ The rules of a script: from the cache, or else from parse(filename)
+
+            Rules are yielded one at a time in both cases. A parsed rule is
+            pickled before it is handed out, so the cache holds the script
+            as read, not the outcomes of the tests that are run later.
+        """
+        stat = os.stat(filename)
+        signature = [stat.st_mtime, stat.st_size, None, SCRIPTS_FORMAT]
+        cached = self.cache_file(filename)
+        try:
+            f = open(cached, 'rb')
+        except IOError:
+            f = None
+        if f is not None:
+            with f:
+                unpickler = cPickle.Unpickler(f)
+                try:
+                    stored = unpickler.load()
+                    if stored[3:] != signature[3:]:
+                        stored = None
+                    elif stored[:2] != signature[:2]:
+                        signature[2] = self.digest(filename)
+                        if stored[2] != signature[2]:
+                            stored = None
+                    if stored is not None:
+                        count = unpickler.load()
+                        rules = [unpickler.load() for _ in xrange(count)]
+                except Exception:
+                    # a cache file of an older version, or a broken one
+                    stored = None
+            if stored is not None:
+                if stored[:2] != signature[:2]:
+                    # same content, new stamps: only the signature is out of date
+                    self.store(cached, signature,
+                               [cPickle.dumps(rule, 2) for rule in rules])
+                for rule in rules:
+                    yield rule
+                return
+        if signature[2] is None:
+            signature[2] = self.digest(filename)
+        pickled = []
+        for rule in parse(filename):
+            pickled.append(cPickle.dumps(rule, 2))
+            yield rule
+        self.store(cached, signature, pickled)
+
+    def store(self, cached, signature, pickled):
+        """ Write the cache file of a script, replacing it in one go
+
+            'pickled' holds one pickle per rule, which are written
+            one after the other so they can be loaded one by one.
+        """
+        temp = "%s.%d" % (cached, os.getpid())
+        with open(temp, 'wb') as f:
+            cPickle.dump(signature, f, 2)
+            cPickle.dump(len(pickled), f, 2)
+            for data in pickled:
+                f.write(data)
+        os.rename(temp, cached)
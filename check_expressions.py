@@ -0,0 +1,88 @@
+#!path/to/python
+""" Checks that evaluating many tests at once gives what evaluating them
+    one by one gives
+
+    Random expressions over a few items are evaluated with evaluate_all
+    (NumPy columns) and with try_evaluate (row by row) on random values,
+    including empty, zero and missing ones. The check fails when the two
+    differ, or when evaluate_all raises.
+"""
+import sys
+import random
+import argparse
+from expression import compile_expression, Unsupported
+
+ITEMS = ['I_A', 'I_B', 'I_C']
+
+# Values of the items, and constants in the expressions
+VALUES = ["", "0", "1", "2.5", "-3", "10", "1e-05"]
+
+COMPARISONS = ['eq', 'ne', 'gt', 'gte', 'lt', 'lte']
+
+
+def number(depth):
+    """ Text of a random arithmetic expression """
+    choice = random.random()
+    if depth <= 0 or choice < 0.4:
+        return random.choice(ITEMS)
+    if choice < 0.6:
+        value = random.choice(VALUES)
+        return '""' if value == "" else value
+    if choice < 0.7:
+        return "-%s" % number(depth - 1)
+    return "(%s %s %s)" % (number(depth - 1), random.choice("+-*/"), number(depth - 1))
+
+
+def condition(depth):
+    """ Text of a random condition """
+    if depth > 0 and random.random() < 0.3:
+        return "(%s %s %s)" % (condition(depth - 1), random.choice(['and', 'or']),
+                               condition(depth - 1))
+    return "%s %s %s" % (number(2), random.choice(COMPARISONS), number(2))
+
+
+def rows(number):
+    """ Random item values; now and then an item is missing """
+    result = []
+    for _ in range(number):
+        row = {}
+        for item in ITEMS:
+            if random.random() > 0.05:
+                row[item] = random.choice(VALUES)
+        result.append(row)
+    return result
+
+
+def check(text, values):
+    """ None if evaluate_all agrees with try_evaluate, else what went wrong """
+    try:
+        expression = compile_expression(text)
+    except Unsupported:
+        return None
+    expected = [expression.try_evaluate(row) for row in values]
+    try:
+        found = expression.evaluate_all(values)
+    except Exception as e:
+        return "raises %s: %s" % (e.__class__.__name__, e)
+    for row, one, all in zip(values, expected, found):
+        if one != all or type(one) != type(all):
+            return "%r for %r, one by one %r" % (all, row, one)
+    return None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--expressions', type=int, default=3000)
+    parser.add_argument('--rows', type=int, default=50)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    random.seed(args.seed)
+    failed = 0
+    for _ in range(args.expressions):
+        text = condition(2)
+        problem = check(text, rows(args.rows))
+        if problem:
+            failed += 1
+            print "%s: %s" % (text, problem)
+    print "%d of %d expressions differ" % (failed, args.expressions)
+    sys.exit(1 if failed else 0)
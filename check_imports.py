@@ -0,0 +1,53 @@
+#!path/to/python
+""" Checks that the quick commands stay quick to start
+
+    Every module is imported in a fresh interpreter, which reports how long
+    the import took and which heavy dependencies it pulled in. The check
+    fails when a module goes over its budget, or imports a dependency that
+    only the browsers and the reports need.
+"""
+import os
+import sys
+import json
+import subprocess
+
+# Seconds an import may take
+BUDGET = 0.1
+
+# Modules that load, summary and the offline evaluation go through
+MODULES = ['validate_rules', 'models', 'cache', 'readers', 'expression']
+
+# Dependencies that must only be imported when they are used
+HEAVY = ['selenium', 'pyvirtualdisplay', 'reportlab', 'PIL', 'requests',
+         'numpy', 'xlrd', 'openpyxl']
+
+MEASURE = """
+import sys, time, json
+start = time.time()
+import %s
+seconds = time.time() - start
+heavy = sorted(set(name.split('.')[0] for name in sys.modules
+                   if sys.modules[name] is not None) & set(%r))
+print json.dumps([seconds, heavy])
+"""
+
+
+def measure(module):
+    """ Seconds to import a module, and the heavy dependencies it imported """
+    output = subprocess.check_output([sys.executable, '-c', MEASURE % (module, HEAVY)],
+                                     cwd=os.path.dirname(os.path.abspath(__file__)))
+    return json.loads(output.splitlines()[-1])
+
+
+if __name__ == "__main__":
+    failed = False
+    for module in MODULES:
+        seconds, heavy = measure(module)
+        problems = []
+        if seconds > BUDGET:
+            problems.append("over budget")
+        if heavy:
+            problems.append("imports %s" % ", ".join(heavy))
+        print "%-16s %6.1f ms %s" % (module, seconds * 1000, "; ".join(problems) or "ok")
+        failed = failed or bool(problems)
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,40 @@
+""" The settings of settings.py, with defaults for the ones that settings.py
+    files of earlier releases do not have
+
+    Modules import their settings from here instead of from settings.py,
+    so an old settings.py keeps working after an upgrade.
+"""
+import settings
+
+OC = settings.OC
+PATH = settings.PATH
+TESTSXLS = getattr(settings, 'TESTSXLS', [])
+
+
+def with_defaults(name, defaults):
+    """ Dictionary 'name' of settings.py, with 'defaults' for the keys it lacks """
+    values = dict(defaults)
+    values.update(getattr(settings, name, {}))
+    return values
+
+
+PATHS = with_defaults('PATHS', {'RESULTS'        : "%s/%s" % (PATH, "results.sqlite"),
+                                'PARSED_SCRIPTS' : "%s/%s" % (PATH, "parsed_scripts"),
+                                'JOURNALS'       : "%s/%s" % (PATH, "journals"),
+                                'HISTORY'        : "%s/%s" % (PATH, "history.sqlite")})
+
+WAITS = with_defaults('WAITS', {'PRESENT' : 15,
+                                'ABSENT'  : 2})
+
+ENGINE = with_defaults('ENGINE', {'CONCURRENCY' : 16,
+                                  'RATE'        : 20,
+                                  'BURST'       : 5,
+                                  'RETRIES'     : 3,
+                                  'BACKOFF'     : 0.5})
+
+SCREENSHOTS = with_defaults('SCREENSHOTS', {'CROP'       : True,
+                                            'MARGIN'     : 10,
+                                            'MAX_WIDTH'  : 1000,
+                                            'MAX_HEIGHT' : 1000,
+                                            'FORMAT'     : 'JPEG',
+                                            'QUALITY'    : 75})
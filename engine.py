@@ -0,0 +1,99 @@
+import time
+import threading
+import Queue
+
+from httpbrowser import HttpBrowser
+
+
+class TokenBucket(object):
+    """ Rate limit shared by threads
+
+        Allows 'rate' requests per second on average, and bursts
+        of at most 'burst' requests after a quiet period.
+    """
+    def __init__(self, rate, burst=1):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = self.burst
+        self.stamp = time.time()
+        self.lock = threading.Lock()
+
+    def take(self):
+        """ Block until a request is allowed """
+        while True:
+            with self.lock:
+                now = time.time()
+                self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+                self.stamp = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class ConcurrentEngine(object):
+    """ Runs many tests at the same time over HTTP
+
+        'concurrency' sessions each run one test at a time, so no more
+        than that many requests are ever outstanding. All sessions share
+        one TokenBucket to protect the OpenClinica server, and retry
+        tests after timeouts and 5xx errors with exponential backoff.
+        Tests, not rules, are the unit of work: the TestRule forms are
+        cached per rule by HttpBrowser, so any session can run any test.
+    """
+    def __init__(self, url, path, concurrency, rate, burst=1, retries=3, backoff=0.5):
+        self.limiter = TokenBucket(rate, burst)
+        self.browsers = [HttpBrowser(url, path) for _ in range(concurrency)]
+        for browser in self.browsers:
+            browser.limiter = self.limiter
+            browser.retries = retries
+            browser.backoff = backoff
+
+    def login(self, user, password):
+        """ Login all sessions to the OpenClinica instance """
+        for browser in self.browsers:
+            browser.login(user, password)
+
+    def set_study(self, study):
+        """ Change all sessions to the study we want to use """
+        for browser in self.browsers:
+            browser.set_study(study)
+
+    def close(self):
+        """ Close all sessions """
+        for browser in self.browsers:
+            browser.close()
+
+    def validate(self, rules):
+        """ Run the tests of all rules concurrently
+
+            The workers start right away, and take tests from the
+            queue while 'rules' is still being read.
+        """
+        queue = Queue.Queue(maxsize=4*len(self.browsers))
+        workers = [threading.Thread(target=self._work, args=(browser, queue))
+                   for browser in self.browsers]
+        for worker in workers:
+            worker.daemon = True
+            worker.start()
+        for rule in rules:
+            print str(rule)
+            for test in rule.pending_tests():
+                queue.put(test)
+        # one stop sign per worker
+        for worker in workers:
+            queue.put(None)
+        for worker in workers:
+            worker.join()
+
+    def _work(self, browser, queue):
+        """ Worker loop: run tests until the stop sign """
+        while True:
+            test = queue.get()
+            if test is None:
+                return
+            try:
+                test.run_test(browser)
+            except Exception as e:
+                print "Test %s aborted: %s" % (test, e)
@@ -0,0 +1,210 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+from xml.sax.saxutils import escape, quoteattr
+from history import connect, update_totals
+from cache import test_key
+
+
+class Exporter(object):
+    """ Writes one record per test, without building any pdf
+
+        Tests that are run are written as soon as they are done (an
+        exporter is a listener of the test battery, see PageSummary).
+        finish writes the other tests: results of earlier runs, results
+        computed offline, and tests that were not run.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        # ids of the tests that have been written
+        self.written = set()
+
+    def record(self, page, rule, test, spans=()):
+        """ Everything there is to know about the result of a test """
+        if test.offline:
+            source = 'offline'
+        elif test.cached:
+            source = 'earlier run'
+        elif test.outcome:
+            source = 'run'
+        else:
+            source = 'not run'
+        phases = {}
+        for span in spans:
+            phases[span.phase] = phases.get(span.phase, 0.0) + span.seconds
+        return {'test_id': test.test_id,
+                'rule': rule.name,
+                'page': page,
+                'inputs': test.test_values,
+                'expected': test.expected_outcome,
+                'outcome': test.outcome,
+                'passed': test.passed(),
+                'source': source,
+                'seconds': sum(phases.values(), 0.0),
+                'phases': phases,
+                'screenshot': test.screenshot,
+                'key': test_key(rule, test)}
+
+    def test_done(self, page, rule, test, spans):
+        record = self.record(page, rule, test, spans)
+        with self.lock:
+            self.written.add(id(test))
+            self.write(record)
+
+    def finish(self, rules):
+        """ Write the tests of 'rules' that have not been written yet, and close """
+        with self.lock:
+            for rule in rules:
+                page = rule.page.name if rule.page is not None else None
+                for test in rule.tests:
+                    if id(test) not in self.written:
+                        self.written.add(id(test))
+                        self.write(self.record(page, rule, test))
+            self.close()
+
+    def write(self, record):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class JsonLinesExporter(Exporter):
+    """ One JSON object per line """
+    def __init__(self, filename):
+        Exporter.__init__(self)
+        self.file = open(filename, 'w')
+
+    def write(self, record):
+        self.file.write(json.dumps(record))
+        self.file.write("\n")
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class JUnitExporter(Exporter):
+    """ JUnit XML, as read by CI dashboards
+
+        A rule is a test class (page.rule), a test a test case. Test cases
+        are streamed to a temporary file, the totals that go in the
+        header are only known at the end.
+    """
+    def __init__(self, filename, name="OpenClinica rules"):
+        Exporter.__init__(self)
+        self.filename = filename
+        self.name = name
+        self.body = open(filename + ".part", 'w')
+        self.counts = {'tests': 0, 'failures': 0, 'skipped': 0, 'time': 0.0}
+
+    def write(self, record):
+        self.counts['tests'] += 1
+        self.counts['time'] += record['seconds']
+        case = '  <testcase classname=%s name=%s time="%.3f"' % (
+                quoteattr(u"%s.%s" % (record['page'], record['rule'])),
+                quoteattr(unicode(record['test_id'])), record['seconds'])
+        if record['source'] == 'not run':
+            self.counts['skipped'] += 1
+            case += '>\n    <skipped/>\n  </testcase>\n'
+        elif not record['passed']:
+            self.counts['failures'] += 1
+            message = "expected %s, got %s" % (record['expected'], record['outcome'] or "Undef")
+            inputs = u", ".join(u"%s=%s" % item for item in record['inputs'].items())
+            case += '>\n    <failure message=%s>%s</failure>\n  </testcase>\n' % (
+                    quoteattr(message), escape(inputs))
+        else:
+            case += '/>\n'
+        self.body.write(case.encode('utf-8'))
+
+    def close(self):
+        self.body.close()
+        with open(self.filename, 'w') as f:
+            f.write('<?xml version="1.0" encoding="utf-8"?>\n')
+            f.write('<testsuite name=%s tests="%d" failures="%d" errors="0" skipped="%d" '
+                    'time="%.3f" timestamp="%s">\n' % (
+                    quoteattr(self.name), self.counts['tests'], self.counts['failures'],
+                    self.counts['skipped'], self.counts['time'],
+                    time.strftime("%Y-%m-%dT%H:%M:%S")))
+            with open(self.filename + ".part") as body:
+                for line in body:
+                    f.write(line)
+            f.write('</testsuite>\n')
+        os.remove(self.filename + ".part")
+
+
+class SqliteExporter(Exporter):
+    """ Results of all runs in one SQLite database, for queries across runs
+        (see history.py)
+
+        Set 'validated' if the tests have been run now, rather than taken
+        from earlier runs (as by the report command). 'shard' is the
+        "i/N" of a run of one shard. Only if 'resume' is set may the run
+        be in the database already: its results are then written again
+        as a whole. Otherwise a run that is there raises ValueError.
+    """
+    def __init__(self, filename, run, validated=True, shard=None, resume=False):
+        Exporter.__init__(self)
+        self.run = run
+        self.db = connect(filename)
+        if resume:
+            self.db.execute("""INSERT OR REPLACE INTO runs (run, started, validated, shard)
+                               VALUES (?, ?, ?, ?)""", (run, time.time(), int(validated), shard))
+            self.db.execute("DELETE FROM results WHERE run = ?", (run,))
+        else:
+            try:
+                self.db.execute("""INSERT INTO runs (run, started, validated, shard)
+                                   VALUES (?, ?, ?, ?)""",
+                                (run, time.time(), int(validated), shard))
+            except sqlite3.IntegrityError:
+                self.db.close()
+                raise ValueError("Run %s is already in the history %s" % (run, filename))
+        self.db.commit()
+        self.pending = 0
+
+    def write(self, record):
+        self.db.execute("""INSERT INTO results (run, page, rule, test_id, inputs, expected,
+                                                outcome, passed, source, seconds, phases,
+                                                screenshot, key)
+                           VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                        (self.run, record['page'], record['rule'], record['test_id'],
+                         json.dumps(record['inputs']), record['expected'],
+                         record['outcome'], record['passed'], record['source'],
+                         record['seconds'], json.dumps(record['phases']),
+                         record['screenshot'], record['key']))
+        # commit now and then, so a crash loses little
+        self.pending += 1
+        if self.pending >= 100:
+            self.db.commit()
+            self.pending = 0
+
+    def close(self):
+        update_totals(self.db, self.run)
+        self.db.commit()
+        self.db.close()
+
+
+# File name in the report folder, per export format
+EXPORTS = {'jsonl': "results.jsonl",
+           'junit': "junit.xml"}
+
+
+def create_exporters(formats, report_path, database, run, validated=True, shard=None,
+                     resume=False):
+    """ An exporter per format: jsonl and junit go in 'report_path',
+        sqlite goes in 'database', under the name 'run' (see SqliteExporter
+        for 'validated', 'shard' and 'resume')
+    """
+    if not os.path.isdir(report_path):
+        os.makedirs(report_path)
+    exporters = []
+    for name in formats:
+        if name == 'jsonl':
+            exporters.append(JsonLinesExporter(os.path.join(report_path, EXPORTS[name])))
+        elif name == 'junit':
+            exporters.append(JUnitExporter(os.path.join(report_path, EXPORTS[name])))
+        elif name == 'sqlite':
+            exporters.append(SqliteExporter(database, run, validated, shard, resume))
+    return exporters
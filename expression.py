@@ -0,0 +1,403 @@
+import re
+import datetime
+
+
+class Unsupported(Exception):
+    """ The expression, or the values it is evaluated with, cannot be
+        handled offline. The test has to be run in OpenClinica.
+    """
+    pass
+
+
+TOKENS = re.compile(r"""\s*(?:
+        (?P<date>\d{4}-\d{2}-\d{2}\b)
+      | (?P<number>\d+(?:\.\d*)?|\.\d+)
+      | (?P<string>"[^"]*"|'[^']*')
+      | (?P<op>!=|<=|>=|==|[()+\-*/<>=])
+      | (?P<name>[A-Za-z_][\w.\[\]]*)
+      )""", re.X)
+
+# Comparison operators of the rule language, and their symbolic forms
+COMPARISONS = {'eq': 'eq', 'ne': 'ne', 'neq': 'ne', 'gt': 'gt', 'gte': 'gte',
+               'lt': 'lt', 'lte': 'lte', 'ct': 'ct', 'nct': 'nct',
+               '=': 'eq', '==': 'eq', '!=': 'ne', '>': 'gt', '>=': 'gte',
+               '<': 'lt', '<=': 'lte'}
+
+DATE_FORMATS = ('%Y-%m-%d', '%d-%b-%Y')
+
+
+def tokenize(text):
+    """ Split an expression in (kind, value) tokens """
+    tokens = []
+    position = 0
+    text = text.strip()
+    while position < len(text):
+        match = TOKENS.match(text, position)
+        if match is None or match.end() == position:
+            raise Unsupported("cannot read '%s'" % text[position:])
+        position = match.end()
+        kind = match.lastgroup
+        value = match.group(kind)
+        if kind == 'name' and value.lower() in COMPARISONS:
+            kind, value = 'op', COMPARISONS[value.lower()]
+        elif kind == 'name' and value.lower() in ('and', 'or'):
+            kind, value = 'op', value.lower()
+        elif kind == 'op' and value in COMPARISONS:
+            value = COMPARISONS[value]
+        tokens.append((kind, value))
+    return tokens
+
+
+def to_value(value):
+    """ Turn an item value from a test script into a number, date or string
+
+        Empty values become "".
+    """
+    if isinstance(value, (int, long, float)):
+        return float(value)
+    value = unicode(value).strip()
+    if value == "":
+        return ""
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    for date_format in DATE_FORMATS:
+        try:
+            return datetime.datetime.strptime(value, date_format).date()
+        except ValueError:
+            pass
+    return value
+
+
+def compare(op, left, right):
+    """ Apply a comparison operator of the rule language """
+    if op in ('ct', 'nct'):
+        found = unicode(right) in unicode(left)
+        return found if op == 'ct' else not found
+    if left == "" or right == "":
+        if op == 'eq':
+            return left == right
+        if op == 'ne':
+            return left != right
+        # an empty item is not greater or smaller than anything
+        return False
+    if type(left) != type(right):
+        if op in ('eq', 'ne') and unicode in (type(left), type(right)):
+            return (op == 'ne')
+        raise Unsupported("cannot compare %r and %r" % (left, right))
+    if op == 'eq':
+        return left == right
+    if op == 'ne':
+        return left != right
+    if isinstance(left, unicode):
+        raise Unsupported("cannot order text")
+    if op == 'gt':
+        return left > right
+    if op == 'gte':
+        return left >= right
+    if op == 'lt':
+        return left < right
+    return left <= right
+
+
+def calculate(op, left, right):
+    """ Apply an arithmetic operator: numbers, or dates and days """
+    if left == "" or right == "":
+        raise Unsupported("arithmetic on an empty item")
+    if isinstance(left, float) and isinstance(right, float):
+        if op == '+':
+            return left + right
+        if op == '-':
+            return left - right
+        if op == '*':
+            return left * right
+        if right == 0:
+            raise Unsupported("division by zero")
+        return left / right
+    if isinstance(left, datetime.date) and isinstance(right, float) and op in ('+', '-'):
+        days = datetime.timedelta(days=right)
+        return left + days if op == '+' else left - days
+    if isinstance(left, datetime.date) and isinstance(right, datetime.date) and op == '-':
+        return float((left - right).days)
+    raise Unsupported("cannot calculate %r %s %r" % (left, op, right))
+
+
+class Expression(object):
+    """ A rule expression, compiled into nested Python functions
+
+        evaluate(values) returns True or False for a dictionary of
+        item keys and values, as in Test.test_values.
+    """
+    # binding power of the binary operators
+    POWER = {'or': 1, 'and': 2, 'eq': 3, 'ne': 3, 'gt': 3, 'gte': 3, 'lt': 3,
+             'lte': 3, 'ct': 3, 'nct': 3, '+': 4, '-': 4, '*': 5, '/': 5}
+
+    def __init__(self, text):
+        self.text = text
+        self.tokens = tokenize(text)
+        self.position = 0
+        self.items = []
+        self.tree = self.parse(0)
+        if self.position != len(self.tokens):
+            raise Unsupported("unexpected '%s'" % self.tokens[self.position][1])
+        self.function = self.build(self.tree)
+        del self.tokens
+
+    def next(self):
+        if self.position >= len(self.tokens):
+            raise Unsupported("unexpected end of '%s'" % self.text)
+        token = self.tokens[self.position]
+        self.position += 1
+        return token
+
+    def peek(self):
+        if self.position < len(self.tokens):
+            return self.tokens[self.position]
+        return (None, None)
+
+    def parse(self, power):
+        """ Parse operands and operators that bind stronger than 'power'
+
+            The tree is made of tuples: (op, left, right) for operators,
+            ('item', key), ('value', value), ('today',) and ('neg', operand).
+        """
+        left = self.operand()
+        while True:
+            kind, op = self.peek()
+            if kind != 'op' or op not in self.POWER or self.POWER[op] <= power:
+                return left
+            self.next()
+            left = (op, left, self.parse(self.POWER[op]))
+
+    def operand(self):
+        kind, value = self.next()
+        if kind == 'op' and value == '(':
+            tree = self.parse(0)
+            if self.next() != ('op', ')'):
+                raise Unsupported("missing ')' in '%s'" % self.text)
+            return tree
+        if kind == 'op' and value == '-':
+            return ('neg', self.operand())
+        if kind == 'number':
+            return ('value', float(value))
+        if kind == 'date':
+            return ('value', to_value(value))
+        if kind == 'string':
+            return ('value', to_value(value[1:-1]))
+        if kind == 'name' and value.upper() == '_CURRENT_DATE':
+            return ('today',)
+        if kind == 'name':
+            if value not in self.items:
+                self.items.append(value)
+            return ('item', value)
+        raise Unsupported("unexpected '%s'" % value)
+
+    def build(self, tree):
+        """ Turn a (sub)tree into a function of the item values """
+        kind = tree[0]
+        if kind == 'value':
+            value = tree[1]
+            return lambda values: value
+        if kind == 'today':
+            return lambda values: datetime.date.today()
+        if kind == 'item':
+            key = tree[1]
+            return lambda values: lookup(values, key)
+        if kind == 'neg':
+            operand = self.build(tree[1])
+            return lambda values: calculate('*', operand(values), -1.0)
+        left, right = self.build(tree[1]), self.build(tree[2])
+        if kind == 'and':
+            return lambda values: truth(left(values)) and truth(right(values))
+        if kind == 'or':
+            return lambda values: truth(left(values)) or truth(right(values))
+        if kind in ('+', '-', '*', '/'):
+            return lambda values: calculate(kind, left(values), right(values))
+        return lambda values: compare(kind, left(values), right(values))
+
+    def evaluate(self, values):
+        """ Evaluate the expression for a dictionary of item keys and values """
+        return truth(self.function(ItemValues(values)))
+
+    def try_evaluate(self, values):
+        """ Like evaluate, but None if the values cannot be handled offline """
+        try:
+            return self.evaluate(values)
+        except Unsupported:
+            return None
+
+    def evaluate_all(self, rows):
+        """ Evaluate the expression for many tests at once
+
+            'rows' is a list of dictionaries of item keys and values. The
+            items are laid out as NumPy columns, and every operator is
+            applied to whole columns at once. Returns a list with True,
+            False, or None for rows that cannot be evaluated offline.
+            Expressions on dates or text, or without NumPy, are evaluated
+            row by row.
+        """
+        try:
+            import numpy
+        except ImportError:
+            numpy = None
+        if numpy is not None and rows:
+            try:
+                columns = Columns(rows, numpy)
+                kind, data, empty, bad = self.vector(self.tree, columns)
+                if kind == 'bool':
+                    return [None if b else d for d, b in zip(data.tolist(), bad.tolist())]
+            except NotVectorised:
+                pass
+        return [self.try_evaluate(row) for row in rows]
+
+    def vector(self, tree, columns):
+        """ Evaluate a (sub)tree on columns
+
+            Returns (kind, data, empty, bad): kind is 'num' or 'bool', data
+            the values, empty marks empty items and bad the rows that
+            cannot be evaluated, with the same rules as evaluate. All
+            are arrays with a value per row, constants too, so that
+            ~ and division by zero work on arrays and never on scalars.
+        """
+        numpy = columns.numpy
+        rows = len(columns.rows)
+        nowhere = numpy.zeros(rows, bool)
+        kind = tree[0]
+        if kind == 'value':
+            if tree[1] == "":
+                return 'num', numpy.full(rows, numpy.nan), numpy.ones(rows, bool), nowhere
+            if isinstance(tree[1], float):
+                return 'num', numpy.full(rows, tree[1]), nowhere, nowhere
+            raise NotVectorised()
+        if kind == 'item':
+            return columns.item(tree[1])
+        if kind == 'neg':
+            kind, data, empty, bad = self.vector(tree[1], columns)
+            if kind != 'num':
+                raise NotVectorised()
+            return 'num', -data, nowhere, bad | empty
+        if kind == 'today':
+            raise NotVectorised()
+        left = self.vector(tree[1], columns)
+        right = self.vector(tree[2], columns)
+        if kind in ('and', 'or'):
+            if left[0] != 'bool' or right[0] != 'bool':
+                raise NotVectorised()
+            if kind == 'and':
+                # the right side only counts where the left side is true
+                return 'bool', left[1] & right[1], nowhere, left[3] | (left[1] & right[3])
+            return 'bool', left[1] | right[1], nowhere, left[3] | (~left[1] & right[3])
+        if left[0] != 'num' or right[0] != 'num':
+            raise NotVectorised()
+        (l, l_data, l_empty, l_bad), (r, r_data, r_empty, r_bad) = left, right
+        bad = l_bad | r_bad
+        either_empty = l_empty | r_empty
+        with numpy.errstate(all='ignore'):
+            if kind in ('+', '-', '*', '/'):
+                bad = bad | either_empty
+                if kind == '+':
+                    data = l_data + r_data
+                elif kind == '-':
+                    data = l_data - r_data
+                elif kind == '*':
+                    data = l_data * r_data
+                else:
+                    bad = bad | (r_data == 0)
+                    data = l_data / r_data
+                return 'num', data, nowhere, bad
+            if kind == 'eq':
+                data = numpy.where(either_empty, l_empty & r_empty, l_data == r_data)
+            elif kind == 'ne':
+                data = numpy.where(either_empty, ~(l_empty & r_empty), l_data != r_data)
+            elif kind == 'gt':
+                data = ~either_empty & (l_data > r_data)
+            elif kind == 'gte':
+                data = ~either_empty & (l_data >= r_data)
+            elif kind == 'lt':
+                data = ~either_empty & (l_data < r_data)
+            elif kind == 'lte':
+                data = ~either_empty & (l_data <= r_data)
+            else:
+                raise NotVectorised()
+        return 'bool', data, nowhere, bad
+
+
+class NotVectorised(Exception):
+    """ The expression has to be evaluated row by row """
+    pass
+
+
+class Columns(object):
+    """ The item values of many tests, as one NumPy column per item """
+    def __init__(self, rows, numpy):
+        self.numpy = numpy
+        self.rows = [ItemValues(row) for row in rows]
+        self.columns = {}
+
+    def item(self, key):
+        """ ('num', values, empty, bad) of an item; bad where it is missing """
+        if key not in self.columns:
+            values = []
+            for row in self.rows:
+                try:
+                    values.append(lookup(row, key))
+                except Unsupported:
+                    values.append(None)
+            if [value for value in values
+                    if value not in ("", None) and not isinstance(value, float)]:
+                raise NotVectorised()
+            numpy = self.numpy
+            empty = numpy.array([value == "" for value in values], bool)
+            bad = numpy.array([value is None for value in values], bool)
+            data = numpy.array([value if isinstance(value, float) else numpy.nan
+                                for value in values], float)
+            self.columns[key] = ('num', data, empty, bad)
+        return self.columns[key]
+
+
+class ItemValues(dict):
+    """ Item values of a test, found by their full path or by their item OID """
+    def __init__(self, values):
+        dict.__init__(self)
+        for key, value in values.items():
+            value = to_value(value)
+            self[key] = value
+            self.setdefault(key.split('.')[-1], value)
+
+
+def lookup(values, key):
+    """ Value of an item in the expression """
+    if key in values:
+        return values[key]
+    oid = key.split('.')[-1]
+    if oid in values:
+        return values[oid]
+    raise Unsupported("no value for item %s" % key)
+
+
+def truth(value):
+    """ The outcome of a condition, which has to be a comparison """
+    if not isinstance(value, bool):
+        raise Unsupported("%r is not a condition" % (value,))
+    return value
+
+
+# Compiled expressions by their text
+_compiled = {}
+
+
+def compile_expression(text):
+    """ Compile a rule expression, once per distinct text
+
+        Raises Unsupported if the expression cannot be handled offline.
+    """
+    if text not in _compiled:
+        try:
+            _compiled[text] = Expression(text)
+        except Unsupported as e:
+            _compiled[text] = e
+    compiled = _compiled[text]
+    if isinstance(compiled, Unsupported):
+        raise compiled
+    return compiled
@@ -1,14 +1,40 @@
 #!path/to/python
+import os
+import re
 import sys
+import decimal
+import datetime
+import itertools
+import multiprocessing
 import xlrd
 import xlwt
 
+# the rule expression evaluator lives in the main folder
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from expression import compile_expression, Unsupported, COMPARISONS
+
+# Value for items that are only compared with the empty value
+NOT_EMPTY = 1.0
+
+# Combinations of candidate values that are tried to find values for
+# which the expression is true, and values for which it is false
+MAX_ASSIGNMENTS = 10000
+
+# Dates are written as OpenClinica shows them on CRFs, e.g. 05-Jan-2024,
+# which the rule expression evaluator reads too (expression.DATE_FORMATS)
+DATE_FORMAT = '%d-%b-%Y'
+
+# Rows of an xls sheet, the title row included
+MAX_ROWS = 65536
+
 class Rule(object):
-    def __init__(self, name, message, expression, items):
+    def __init__(self, name, message, expression, items, fires_when=None):
         self.name = name
         self.message = message
         self.expression = expression
         self.items = items
+        # value of the expression for which the actions fire, None if unknown
+        self.fires_when = fires_when
 
 def uniqify(seq, idfun=None):
     # order preserving
@@ -25,75 +51,313 @@ def uniqify(seq, idfun=None):
         result.append(item)
     return result
 
+# Columns of the rules export that are used: header label,
+# and the position of the column in exports without that label
+COLUMNS = {'name': ('Rule OID', 6),
+           'status': ('Rule Status', 8),
+           'expression': ('Rule Expression', 10),
+           'action': ('Action Type', 13),
+           'message': ('Action Summary', 14)}
+
+# Quoted text in an expression, and names that may be item OIDs
+QUOTED = re.compile(r"\"[^\"]*\"|'[^']*'")
+NAMES = re.compile(r"[A-Za-z_][\w.\[\]]*")
+KEYWORDS = set(COMPARISONS) | set(['and', 'or', '_current_date'])
+
+# Header labels of the column that tells whether the actions of a rule
+# fire when its expression is true or false; exports without it leave
+# the expected outcomes to be filled in by hand
+FIRES_WHEN_LABELS = ('Execute On', 'Action Execute On', 'If Expression Evaluates')
+
+
+def column_index(header):
+    """ Position of each used column, found by its header label; the
+        'fires_when' column is only there if one of its labels is found
+    """
+    labels = [" ".join(unicode(label).split()).lower() for label in header]
+    index = {}
+    for column, (label, position) in COLUMNS.items():
+        if label.lower() in labels:
+            index[column] = labels.index(label.lower())
+        else:
+            index[column] = position
+    for label in FIRES_WHEN_LABELS:
+        if label.lower() in labels:
+            index['fires_when'] = labels.index(label.lower())
+            break
+    return index
+
+
+def polarity(value):
+    """ True or False for the value of the expression that makes the
+        actions fire, as the rules export gives it; None if unknown
+    """
+    text = unicode(value).strip().lower()
+    if text in ('true', '1', '1.0'):
+        return True
+    if text in ('false', '0', '0.0'):
+        return False
+    return None
+
+
+def expression_items(expression):
+    """ The item OIDs in an expression, in order of appearance """
+    names = NAMES.findall(QUOTED.sub(" ", expression))
+    return uniqify([name for name in names if name.lower() not in KEYWORDS])
+
+
 def read_rules(rules):
-    rule_list = []
-    for rownum in range(rules.nrows)[1:]:
-        if (rules.row_values(rownum)[13] != 'ShowAction' and
-           rules.row_values(rownum)[8] == 'available'):
-                name = rules.row_values(rownum)[6]
-                message = " ".join(rules.row_values(rownum)[14].split())
-                expression = rules.row_values(rownum)[10]
-                items = uniqify([r for r in rules.row_values(rownum)[10]
-                                 .replace('(', '')
-                                 .replace(')', '')
-                                 .split() if len(r) > 5])
-                rule_list.append(Rule(name, message, expression, items))
-    return rule_list
+    """ Yield the available rules of the rules export sheet, one row at a time """
+    index = column_index(rules.row_values(0))
+    for rownum in xrange(1, rules.nrows):
+        row = rules.row_values(rownum)
+        if (row[index['action']] != 'ShowAction' and
+           row[index['status']] == 'available'):
+                expression = row[index['expression']]
+                fires_when = None
+                if 'fires_when' in index:
+                    fires_when = polarity(row[index['fires_when']])
+                yield Rule(row[index['name']],
+                           " ".join(row[index['message']].split()),
+                           expression,
+                           expression_items(expression),
+                           fires_when)
+
+
+def convert(xls_in, xls_out):
+    """ Write a test script for the rules export 'xls_in' to 'xls_out' """
+    book = xlrd.open_workbook(xls_in, on_demand=True)
+    create_tests(read_rules(book.sheet_by_index(0)), xls_out)
+    book.release_resources()
+    return xls_out
+
+
+def convert_job(job):
+    """ convert, for a worker process """
+    return convert(*job)
+
+
+def boundary_values(op, constant):
+    """ Values around a constant: on it, just inside and just outside """
+    if isinstance(constant, datetime.date):
+        step = datetime.timedelta(days=1)
+    elif isinstance(constant, float):
+        # repr may use an exponent: 1e-05 has 5 decimals
+        exponent = decimal.Decimal(repr(constant)).normalize().as_tuple().exponent
+        decimals = max(-exponent, 0)
+        step = 10.0 ** -decimals
+    else:
+        # text can only be equal or not
+        return [constant, constant + "_X"]
+    if isinstance(constant, float):
+        return [constant, round(constant - step, decimals), round(constant + step, decimals)]
+    return [constant, constant - step, constant + step]
+
+
+def constant_value(tree):
+    """ (True, value) if 'tree' is a constant, or a negated number; else (False, None) """
+    if tree[0] == 'value':
+        return True, tree[1]
+    if tree[0] == 'neg' and tree[1][0] == 'value' and isinstance(tree[1][1], float):
+        return True, -tree[1][1]
+    return False, None
+
+
+def comparisons(tree):
+    """ Yield (item, op, constant) for every comparison of an item with a constant """
+    if tree[0] in ('and', 'or'):
+        for comparison in comparisons(tree[1]):
+            yield comparison
+        for comparison in comparisons(tree[2]):
+            yield comparison
+    elif len(tree) == 3 and tree[1][0] == 'item':
+        is_constant, value = constant_value(tree[2])
+        if is_constant:
+            yield tree[1][1], tree[0], value
+    elif len(tree) == 3 and tree[2][0] == 'item':
+        is_constant, value = constant_value(tree[1])
+        if is_constant:
+            yield tree[2][1], tree[0], value
+
+
+def find_assignments(expression, items, candidates):
+    """ Values of 'items' for which the expression is true, and values for
+        which it is false, from the combinations of their 'candidates'
+
+        Combinations without empty values are tried first, and at most
+        MAX_ASSIGNMENTS of them. Either is None if it is not found.
+    """
+    # stable sort: the empty value goes last, the order is kept otherwise
+    choices = [sorted(candidates[item] + [""], key=lambda value: value == "")
+               for item in items]
+    found = {}
+    for combination in itertools.islice(itertools.product(*choices), MAX_ASSIGNMENTS):
+        values = dict(zip(items, combination))
+        try:
+            result = bool(expression.evaluate(values))
+        except Unsupported:
+            continue
+        found.setdefault(result, values)
+        if len(found) == 2:
+            break
+    return found.get(True), found.get(False)
+
+
+def generate_tests(rule):
+    """ Boundary-value tests for a rule, as (expected outcome, values) pairs
+
+        For every comparison of an item with a constant, the item gets the
+        constant, a value just inside and a value just outside of it, and
+        an empty value; an item only compared with "" also gets NOT_EMPTY.
+        Meanwhile the other items keep values for which the expression is
+        true, and then values for which it is false (see find_assignments),
+        so the tests cross the boundaries of conjunctions too. Without
+        those, they keep the first constant they are compared with that is
+        not empty. The expected outcome is computed from the
+        expression if it is known when the actions of the rule fire, else
+        it is left empty. Yields nothing if the expression is not supported.
+    """
+    try:
+        expression = compile_expression(rule.expression)
+    except Unsupported:
+        return
+    candidates = {}
+    for item, op, constant in comparisons(expression.tree):
+        if constant == "":
+            candidates.setdefault(item, []).append("")
+        else:
+            candidates.setdefault(item, []).extend(boundary_values(op, constant))
+    if not candidates:
+        return
+    # an item that is only compared with "" also gets a value that is not empty
+    for item, values in candidates.items():
+        if not any(value != "" for value in values):
+            values.append(NOT_EMPTY)
+    items = [item for item in expression.items if item in candidates]
+    bases = [base for base in find_assignments(expression, items, candidates)
+             if base is not None]
+    if not bases:
+        bases = [dict((item, [value for value in candidates[item] if value != ""][0])
+                      for item in items)]
+    seen = set()
+    for base in bases:
+        for item in items:
+            for value in candidates[item] + [""]:
+                values = dict(base)
+                values[item] = value
+                key = tuple(values[i] for i in items)
+                if key in seen:
+                    continue
+                seen.add(key)
+                try:
+                    result = expression.evaluate(values)
+                except Unsupported:
+                    continue
+                if rule.fires_when is None:
+                    expected = ""
+                else:
+                    expected = "Fires" if result == rule.fires_when else "FiresNot"
+                yield expected, [(i, values[i]) for i in items]
+
+
+def write_test(sheet, row, test_id, rule, expected, values, widths):
+    """ Write one test row: id, rule, expected outcome, when the actions
+        fire, whether the expected outcome was generated, and item/value pairs
+
+        Raises ValueError if the row does not fit in the sheet.
+    """
+    if row >= MAX_ROWS:
+        raise ValueError("test %s does not fit: a sheet of an xls file has at most %d rows, "
+                         "split the rules export in smaller ones" % (test_id, MAX_ROWS))
+    sheet.write(row, 0, test_id)
+    sheet.write(row, 1, rule.name)
+    sheet.write(row, 2, rule.message)
+    sheet.write(row, 3, rule.expression)
+    sheet.write(row, 4, expected)
+    if rule.fires_when is not None:
+        sheet.write(row, 5, "true" if rule.fires_when else "false")
+    if expected:
+        # checked in OpenClinica like any other, but not against the expression
+        sheet.write(row, 6, "yes")
+    col = 7
+    for item, value in values:
+        sheet.write(row, col, item)
+        if widths.get(col, 0) < len(item):
+            sheet.col(col).width = (len(item) + 6) * 256
+            widths[col] = len(item)
+        if isinstance(value, datetime.date):
+            value = value.strftime(DATE_FORMAT)
+        if value is not None:
+            sheet.write(row, col + 1, value)
+        sheet.col(col + 1).width = 20 * 256
+        col += 2  # skip a cell so that value can be entered
+
 
 def create_tests(rule_list, xls_out):
+    """ Write a test script for the rules
+
+        Rules with a supported expression get boundary-value tests, written
+        as they are generated. Their expected outcome is filled in, and
+        marked as generated, if the rules export tells when the actions
+        fire. Other rules get one row per item, to be filled in by hand.
+    """
     workbook = xlwt.Workbook()
     sheet = workbook.add_sheet("Tests")
     
-    col = 0
-    row = 1
-    
     sheet.write(0, 0, "Test ID")
     sheet.write(0, 1, "Rule Name")
     sheet.write(0, 2, "Rule Message")
     sheet.write(0, 3, "Rule Expression")
     sheet.write(0, 4, "Expected Result")
-    sheet.write(0, 5, "Rule Item")
-    sheet.write(0, 6, "Rule Item Value")
-    
-    max_width = 0
+    sheet.write(0, 5, "Fires When")
+    sheet.write(0, 6, "Generated")
+    sheet.write(0, 7, "Rule Item")
+    sheet.write(0, 8, "Rule Item Value")
     
+    row = 1
+    widths = {}
     for r in rule_list:
-        for x in range(len(r.items)):
-            sheet.write(row, col, "%s_%02d" % (r.name, x + 1))
-            sheet.write(row, col+1, r.name)
-            sheet.write(row, col+2, r.message)
-            sheet.write(row, col+3, r.expression)
-            offset = 5
-            for item in r.items:
-                # sheet.write(0,col+offset,"Rule Item")
-                sheet.write(row, col + offset, item)
-                if max_width < len(item):
-                    sheet.col(col+offset).width = (len(item) + 6) * 256
-                    max_width = len(item)
-    
-                # sheet.write(0, col+offset+1, "Rule Item Value")
-                sheet.col(col+offset+1).width = 20 * 256
-    
-                offset += 2  # skip a cell so that value can be entered
+        number = 0
+        for expected, values in generate_tests(r):
+            number += 1
+            write_test(sheet, row, "%s_%02d" % (r.name, number), r, expected, values, widths)
             row += 1
+        if number == 0:
+            for x in range(len(r.items)):
+                write_test(sheet, row, "%s_%02d" % (r.name, x + 1), r, "",
+                           [(item, None) for item in r.items], widths)
+                row += 1
     workbook.save(xls_out)
 
 
 if __name__ == '__main__':
     
-    rule_list = []
-    if len(sys.argv[1:]) != 2:
-        print("Exactly two arguments expected")
+    if len(sys.argv[1:]) < 2:
+        print("Usage: extract_rules.py rules.xls [rules2.xls ...] output")
+        print("With more than one rules export, output is a folder")
         sys.exit(2)
     
-    xls_in = sys.argv[1]
-    xls_out = sys.argv[2]
-    
+    xls_in = sys.argv[1:-1]
+    xls_out = sys.argv[-1]
+
+    for filename in xls_in:
+        if not os.path.isfile(filename):
+            print("input file not found: %s" % filename)
+            sys.exit(2)
+
     try:
-        rules = xlrd.open_workbook(xls_in).sheet_by_index(0)
-    except:
-        print("input file not found")
-        sys.exit(2)
-        
-    rule_list = read_rules(rules)
-    create_tests(rule_list, xls_out)
+        if len(xls_in) == 1:
+            convert(xls_in[0], xls_out)
+        else:
+            if not os.path.isdir(xls_out):
+                os.makedirs(xls_out)
+            jobs = [(filename, os.path.join(xls_out, "tests_%s" % os.path.basename(filename)))
+                    for filename in xls_in]
+            pool = multiprocessing.Pool()
+            for written in pool.imap_unordered(convert_job, jobs):
+                print(written)
+            pool.close()
+            pool.join()
+    except ValueError as e:
+        print(e)
+        sys.exit(1)
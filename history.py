@@ -0,0 +1,180 @@
+import sqlite3
+
+# Tables and indexes of the history database: the tests of all runs, and
+# the totals per run. Diffs look tests up by run, the history of a test
+# is looked up by page, rule and test. 'key' is the hash of the definition
+# of the test (see cache.test_key). Runs with 'validated' 0 are exports by
+# the report command of results of earlier runs: they are not used for
+# diffs, trends and scheduling. 'shard' is "i/N" for a run of one shard;
+# such runs only have part of the tests, so by default diffs and trends
+# leave them out.
+SCHEMA = ("""CREATE TABLE IF NOT EXISTS runs (
+                 run TEXT PRIMARY KEY,
+                 started REAL,
+                 tests INTEGER,
+                 passed INTEGER,
+                 validated INTEGER,
+                 shard TEXT)""",
+          """CREATE TABLE IF NOT EXISTS results (
+                 run TEXT,
+                 page TEXT,
+                 rule TEXT,
+                 test_id TEXT,
+                 inputs TEXT,
+                 expected TEXT,
+                 outcome TEXT,
+                 passed INTEGER,
+                 source TEXT,
+                 seconds REAL,
+                 phases TEXT,
+                 screenshot TEXT,
+                 key TEXT)""",
+          "CREATE INDEX IF NOT EXISTS results_run ON results (run, page, rule, test_id)",
+          "CREATE INDEX IF NOT EXISTS results_test ON results (page, rule, test_id, run)")
+
+
+def connect(filename):
+    """ Open the history database, creating or upgrading its tables """
+    db = sqlite3.connect(filename, check_same_thread=False)
+    for statement in SCHEMA:
+        db.execute(statement)
+    # databases of earlier releases have no totals per run, and no keys
+    for table, column, kind in (('runs', 'tests', 'INTEGER'), ('runs', 'passed', 'INTEGER'),
+                                ('runs', 'validated', 'INTEGER'), ('runs', 'shard', 'TEXT'),
+                                ('results', 'key', 'TEXT')):
+        if column not in [row[1] for row in db.execute("PRAGMA table_info(%s)" % table)]:
+            db.execute("ALTER TABLE %s ADD COLUMN %s %s" % (table, column, kind))
+    db.commit()
+    return db
+
+
+def update_totals(db, run):
+    """ Count the tests and passed tests of 'run', and store them with the run """
+    tests, passed = db.execute("SELECT count(*), total(passed) FROM results WHERE run = ?",
+                               (run,)).fetchone()
+    db.execute("UPDATE runs SET tests = ?, passed = ? WHERE run = ?", (tests, int(passed), run))
+    return tests, int(passed)
+
+
+class History(object):
+    """ Outcomes of the tests of all runs, as written by SqliteExporter
+
+        Runs are named after the time they started, so they sort in order.
+    """
+    def __init__(self, filename):
+        self.db = connect(filename)
+
+    def runs(self):
+        """ Names of all runs, oldest first, exports of the report command too """
+        return [row[0] for row in self.db.execute("SELECT run FROM runs ORDER BY run")]
+
+    def shard(self, run):
+        """ The "i/N" of a run of one shard, None for a run of all rules """
+        row = self.db.execute("SELECT shard FROM runs WHERE run = ?", (run,)).fetchone()
+        return row and row[0]
+
+    def latest(self, before=None, sharded=False, shard=None):
+        """ The last validation run, or the last one before 'before';
+            None if there is none. Runs of a shard only count if 'sharded',
+            with 'shard' only the runs of that shard count.
+        """
+        condition, parameters = "validated IS NOT 0", []
+        if shard is not None:
+            condition += " AND shard = ?"
+            parameters.append(shard)
+        elif not sharded:
+            condition += " AND shard IS NULL"
+        if before is not None:
+            condition += " AND run < ?"
+            parameters.append(before)
+        return self.db.execute("SELECT max(run) FROM runs WHERE %s" % condition,
+                               parameters).fetchone()[0]
+
+    def trend(self, number=30, sharded=False):
+        """ Totals of the last 'number' validation runs, oldest first; runs
+            of a shard only count if 'sharded'
+
+            A list of dictionaries with run, started, tests and passed.
+        """
+        condition = "validated IS NOT 0"
+        if not sharded:
+            condition += " AND shard IS NULL"
+        rows = self.db.execute("""SELECT run, started, tests, passed FROM runs
+                                  WHERE %s ORDER BY run DESC LIMIT ?""" % condition,
+                               (number,)).fetchall()
+        trend = []
+        for run, started, tests, passed in reversed(rows):
+            if tests is None:
+                tests, passed = update_totals(self.db, run)
+                self.db.commit()
+            trend.append({'run': run, 'started': started, 'tests': tests, 'passed': passed})
+        return trend
+
+    def diff(self, old, new):
+        """ Tests that regressed, were fixed, or are new in run 'new' since run 'old'
+
+            Returns a dictionary with a sorted list of (page, rule, test_id,
+            outcome) per kind of change; outcome is the one of run 'new'.
+        """
+        changes = {'regressed': [], 'fixed': [], 'new': []}
+        for page, rule, test_id, outcome, passed, was_passed in self.db.execute(
+                """SELECT new.page, new.rule, new.test_id, new.outcome,
+                          new.passed, old.passed
+                   FROM results AS new LEFT JOIN results AS old
+                   ON old.run = ? AND old.page = new.page AND old.rule = new.rule
+                      AND old.test_id = new.test_id
+                   WHERE new.run = ?""", (old, new)):
+            if was_passed is None:
+                kind = 'new'
+            elif was_passed and not passed:
+                kind = 'regressed'
+            elif passed and not was_passed:
+                kind = 'fixed'
+            else:
+                continue
+            changes[kind].append((page, rule, test_id, outcome))
+        for tests in changes.values():
+            tests.sort()
+        return changes
+
+    def rule_stats(self, runs=10, until=None):
+        """ What the last 'runs' validation runs say about every rule, by (page, rule)
+
+            A dictionary with the number of tests that 'failed' in the last
+            of these runs that had the rule, the 'keys' of its tests in that
+            run, and the average 'seconds' a test took (None if none of its
+            tests was run in OpenClinica). Shards of a run are separate
+            runs, so the last run need not have all rules. With 'until',
+            only runs up to that one are used: the history as it was then.
+        """
+        if until is None:
+            recent = self.db.execute("""SELECT run FROM runs WHERE validated IS NOT 0
+                                        ORDER BY run DESC LIMIT ?""", (runs,))
+        else:
+            recent = self.db.execute("""SELECT run FROM runs WHERE validated IS NOT 0
+                                        AND run <= ? ORDER BY run DESC LIMIT ?""",
+                                     (until, runs))
+        recent = [row[0] for row in recent]
+        stats = {}
+        durations = {}
+        for run, page, rule, key, passed, source, seconds in self.db.execute(
+                """SELECT run, page, rule, key, passed, source, seconds FROM results
+                   WHERE run IN (%s) ORDER BY run DESC""" % ", ".join("?" * len(recent)),
+                recent):
+            rule_stats = stats.get((page, rule))
+            if rule_stats is None:
+                rule_stats = stats[page, rule] = {'run': run, 'failed': 0, 'keys': set(),
+                                                  'seconds': None}
+            if rule_stats['run'] == run:
+                rule_stats['keys'].add(key)
+                if not passed:
+                    rule_stats['failed'] += 1
+            if source == 'run':
+                total, tests = durations.get((page, rule), (0.0, 0))
+                durations[page, rule] = (total + seconds, tests + 1)
+        for rule, (total, tests) in durations.items():
+            stats[rule]['seconds'] = total / tests
+        return stats
+
+    def close(self):
+        self.db.close()
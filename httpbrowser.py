@@ -0,0 +1,373 @@
+import re
+import time
+import random
+import threading
+from urlparse import urljoin
+from HTMLParser import HTMLParser
+
+import requests
+
+from models import BaseBrowser, LoginError, format_value
+from config import WAITS
+
+
+class Form(object):
+    """ A html form: where it is sent to, and the values it would send """
+    def __init__(self, action, method):
+        self.action = action
+        self.method = method
+        self.url = ''
+        self.fields = []
+        self.names = set()
+        self.ids = {}
+        self.buttons = []
+
+    def field(self, key):
+        """ Name of the field with id or name 'key', None if there is none """
+        if key in self.ids:
+            return self.ids[key]
+        if key in self.names:
+            return key
+        return None
+
+    def values(self, updates={}, button=None):
+        """ The values to send, with 'updates' replacing the defaults.
+
+            'button' is the name or value of the submit button that is clicked.
+        """
+        values = [(name, value) for name, value in self.fields if name not in updates]
+        values.extend(updates.items())
+        for name, value in self.buttons:
+            if button in (name, value):
+                values.append((name, value))
+                break
+        return values
+
+
+class PageParser(HTMLParser):
+    """ Collects the forms, links and table rows of an OpenClinica page """
+    def __init__(self):
+        HTMLParser.__init__(self)
+        self.forms = []
+        self.links = []
+        self.rows = []
+        self.form = None
+        self.row = None
+        self.cell = None
+        self.textarea = None
+        self.select = None
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        if tag == 'form':
+            self.form = Form(attrs.get('action', ''), attrs.get('method', 'get').lower())
+            self.forms.append(self.form)
+        elif tag == 'a' and 'href' in attrs:
+            self.links.append(attrs['href'])
+        elif tag == 'tr':
+            self.row = []
+            self.rows.append(self.row)
+        elif tag in ('td', 'th') and self.row is not None:
+            self.cell = []
+            self.row.append(self.cell)
+        elif self.form is not None:
+            self.handle_field(tag, attrs)
+
+    def handle_field(self, tag, attrs):
+        """ Remember the value an input element would send """
+        name = attrs.get('name')
+        if name:
+            self.form.names.add(name)
+        if tag == 'input' and name:
+            kind = attrs.get('type', 'text').lower()
+            value = attrs.get('value', '')
+            if 'id' in attrs:
+                self.form.ids[attrs['id']] = name
+            if kind in ('submit', 'button', 'image'):
+                self.form.buttons.append((name, value))
+            elif kind not in ('radio', 'checkbox') or 'checked' in attrs:
+                self.form.fields.append((name, value))
+            return
+        elif tag == 'textarea' and name:
+            self.textarea = [name, '']
+        elif tag == 'select' and name:
+            self.select = [name, None]
+        elif tag == 'option' and self.select is not None:
+            if self.select[1] is None or 'selected' in attrs:
+                self.select[1] = attrs.get('value', '')
+        else:
+            return
+        if name and 'id' in attrs:
+            self.form.ids[attrs['id']] = name
+
+    def handle_endtag(self, tag):
+        if tag == 'form':
+            self.form = None
+        elif tag == 'tr':
+            self.row = None
+            self.cell = None
+        elif tag in ('td', 'th'):
+            self.cell = None
+        elif tag == 'textarea' and self.textarea is not None:
+            self.form.fields.append(tuple(self.textarea))
+            self.textarea = None
+        elif tag == 'select' and self.select is not None:
+            self.form.fields.append((self.select[0], self.select[1] or ''))
+            self.select = None
+
+    def handle_data(self, data):
+        if self.cell is not None:
+            self.cell.append(data)
+        if self.textarea is not None:
+            self.textarea[1] += data
+
+    def cell_after(self, label):
+        """ Text of the table cell that follows the cell containing 'label' """
+        for row in self.rows:
+            texts = [" ".join("".join(cell).split()) for cell in row]
+            for i, text in enumerate(texts[:-1]):
+                if label in text:
+                    return texts[i+1]
+        return None
+
+    def form_with(self, name):
+        """ The first form that has a field or button with this name or value """
+        for form in self.forms:
+            if name in form.names or name in [value for n, value in form.buttons]:
+                return form
+        return None
+
+
+def is_transient(error):
+    """ Check if a request error is worth trying again """
+    if isinstance(error, (requests.Timeout, requests.ConnectionError)):
+        return True
+    response = getattr(error, 'response', None)
+    return response is not None and response.status_code >= 500
+
+
+def parse(html):
+    """ Parse a page and return the parser with its contents """
+    parser = PageParser()
+    parser.feed(html)
+    parser.close()
+    return parser
+
+
+class HttpBrowser(BaseBrowser):
+    """ Runs tests by sending the TestRule form to OpenClinica directly
+
+        This does the same as Browser, but without Firefox: the pages are
+        requested over one cookie-persistent HTTP session with a pool of
+        kept-alive connections, and the result is read from the html.
+        No screenshots are made.
+    """
+    # TestRule url per rule name, shared by all sessions
+    rule_urls = {}
+    # Parsed TestRule form per rule name, shared by all sessions;
+    # False for rules that have no TestRule form
+    forms = {}
+    # Lock per rule name, so the form of a rule is loaded by one session
+    # while the others wait for it
+    form_locks = {}
+    form_locks_lock = threading.Lock()
+
+    def __init__(self, url, path):
+        BaseBrowser.__init__(self, url, path)
+        self.start()
+        self.form = None
+        # attempts after a failed request, and seconds to wait before the
+        # first; the same as the defaults of ConcurrentEngine
+        self.retries = 3
+        self.backoff = 0.5
+        # optional TokenBucket that every request has to pass
+        self.limiter = None
+
+    def start(self):
+        """ Start a new HTTP session, with a pool of kept-alive connections """
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=4)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.form = None
+
+    def get(self, url):
+        """ Request a page and parse it """
+        if self.limiter is not None:
+            self.limiter.take()
+        response = self.session.get(url, timeout=WAITS['PRESENT'])
+        response.raise_for_status()
+        return response, parse(response.text)
+
+    def send(self, page_url, form, updates={}, button=None):
+        """ Submit a form as if 'button' was clicked, and parse the result """
+        url = urljoin(page_url, form.action or page_url)
+        values = form.values(updates, button)
+        if self.limiter is not None:
+            self.limiter.take()
+        if form.method == 'post':
+            response = self.session.post(url, data=values, timeout=WAITS['PRESENT'])
+        else:
+            response = self.session.get(url, params=values, timeout=WAITS['PRESENT'])
+        response.raise_for_status()
+        return response, parse(response.text)
+
+    def login(self, user, password):
+        """ Login to the OpenClinica instance, raises LoginError if that fails """
+        self.credentials = (user, password)
+        try:
+            response, page = self.get(self.url)
+            form = page.form_with("j_username")
+            response, page = self.send(response.url, form,
+                    {'j_username': user, 'j_password': password}, 'submit')
+            # a failed login shows the login form again
+            if page.form_with("j_username") is not None:
+                raise LoginError("Unable to log in: login refused")
+        except (requests.RequestException, AttributeError) as e:
+            raise LoginError("Unable to log in: %s" % e)
+
+    def set_study(self, study):
+        """ Change (if needed) to the study we want to use
+
+            Raises LoginError if the study is not found.
+        """
+        self.study = study
+        try:
+            response = self.session.get(self.url, timeout=WAITS['PRESENT'])
+        except requests.RequestException as e:
+            raise LoginError("Unable to reach OpenClinica: %s" % e)
+        current = re.search(r"id=['\"]StudyInfo['\"].*?<b>\s*<a[^>]*>(.*?)</a>",
+                            response.text, re.S)
+        if current and current.group(1).strip() == study:
+            return
+        try:
+            url = urljoin(self.url, "ChangeStudy")
+            response, page = self.get(url)
+            study_id = None
+            for cell in re.findall(r"<td[^>]*>(.*?)</td>", response.text, re.S | re.I):
+                if re.search(r"<b>[^<]*%s" % re.escape(study), cell):
+                    study_id = re.search(r"name=['\"]studyId['\"][^>]*value=['\"]([^'\"]*)",
+                                         cell).group(1)
+                    break
+            if study_id is None:
+                raise LoginError("Study %s not found" % study)
+            form = page.form_with("studyId")
+            response, page = self.send(response.url, form, {'studyId': study_id}, 'Submit')
+            form = page.form_with("Submit")
+            self.send(response.url, form, {}, 'Submit')
+        except (requests.RequestException, AttributeError):
+            raise LoginError("Study %s not found" % study)
+
+    def alive(self):
+        """ Check that OpenClinica answers, and has not logged us out """
+        try:
+            response, page = self.get(self.url)
+        except requests.RequestException:
+            return False
+        return page.form_with("j_username") is None
+
+    def close(self):
+        """ Close the HTTP session """
+        self.session.close()
+
+    def open_rule(self, rule_name):
+        """ Fetch and parse the TestRule form of a rule
+
+            Returns True if the form could be opened.
+        """
+        try:
+            return self.load_form(rule_name)
+        except requests.RequestException:
+            return False
+
+    def load_form(self, rule_name):
+        """ Fetch and parse the TestRule form of a rule
+
+            The url and the form are cached per rule name, so every
+            later test of the rule only needs one request. When sessions
+            run tests of the same rule at the same time, one of them
+            fetches the form, the others wait for it.
+            Returns False if the rule has no TestRule form, connection
+            and server errors are raised.
+        """
+        self.rule = None
+        self.form = None
+        form = HttpBrowser.forms.get(rule_name)
+        if form is None:
+            with HttpBrowser.form_locks_lock:
+                lock = HttpBrowser.form_locks.setdefault(rule_name, threading.Lock())
+            with lock:
+                form = HttpBrowser.forms.get(rule_name)
+                if form is None:
+                    form = HttpBrowser.forms[rule_name] = self.fetch_form(rule_name)
+        if form is False:
+            return False
+        self.form = form
+        self.rule = rule_name
+        return True
+
+    def fetch_form(self, rule_name):
+        """ The TestRule form of a rule, False if it has none """
+        url = HttpBrowser.rule_urls.get(rule_name)
+        if url is None:
+            with self.phase('rule_page'):
+                response, page = self.get(self.rule_page(rule_name))
+                links = [link for link in page.links if 'TestRule' in link]
+                if len(links) < 2:
+                    return False
+                url = urljoin(response.url, links[1])
+                HttpBrowser.rule_urls[rule_name] = url
+        with self.phase('open'):
+            response, page = self.get(url)
+            form = page.form_with('Validate & Test')
+            if form is None:
+                return False
+            response, page = self.send(response.url, form, {}, 'Validate & Test')
+            form = page.form_with('Validate & Test')
+            if form is None:
+                return False
+            form.url = response.url
+            return form
+
+    def execute(self, test):
+        """ Submit the TestRule form with the values of one test
+
+            Connection and server errors are raised, so the caller
+            can decide to try again.
+        """
+        if self.rule != test.rule and not self.load_form(test.rule):
+            return 'Undef', ''
+        with self.phase('fill'):
+            updates = {}
+            for k, v in test.test_values.items():
+                name = self.form.field(k)
+                if name is None:
+                    return 'Undef', ''
+                updates[name] = format_value(v)
+        with self.phase('submit'):
+            response, page = self.send(self.form.url, self.form,
+                                       updates, 'Validate & Test')
+        with self.phase('result'):
+            action = page.cell_after('Actions Fired')
+        if action == 'N':
+            result = "FiresNot"
+        elif action == 'Y':
+            result = "Fires"
+        else:
+            result = "Undef"
+        return (result, '')
+
+    def _run_test(self, test):
+        """ Run one test, trying again after timeouts and server errors """
+        attempt = 0
+        while True:
+            try:
+                return self.execute(test)
+            except requests.RequestException as e:
+                self.rule = None
+                if attempt >= self.retries or not is_transient(e):
+                    return 'Undef', ''
+            # exponential backoff, with jitter so retries do not come in waves
+            with self.phase('backoff'):
+                time.sleep(self.backoff * 2 ** attempt * random.uniform(1, 1.5))
+            attempt += 1
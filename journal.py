@@ -0,0 +1,70 @@
+import os
+import json
+import time
+import threading
+
+from cache import test_key
+
+
+class Journal(object):
+    """ The outcomes of one validation run, written as they come in
+
+        Every test that has been run is appended to a file of JSON lines
+        right away, so a run that crashes can be resumed: the tests in
+        the journal get their outcome back, and only the others are run.
+        Undefined outcomes are written too, but run again when resumed,
+        as they may have been caused by the crash.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.records = {}
+        if os.path.exists(filename):
+            self.records = self.load(filename)
+        self.file = open(filename, 'a')
+        self.lock = threading.Lock()
+        # number of tests that got their outcome from the journal
+        self.restored = 0
+
+    def load(self, filename):
+        """ The last record of every test in a journal, by test_key """
+        records = {}
+        with open(filename) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # the last line of a run that was killed while writing it
+                    continue
+                records[record['key']] = record
+        return records
+
+    def restoring(self, rules):
+        """ Pass on 'rules', after giving their tests the outcome in the journal """
+        for rule in rules:
+            for test in rule.tests:
+                record = self.records.get(test_key(rule, test))
+                if record is None or record['outcome'] not in ("Fires", "FiresNot"):
+                    continue
+                if record['screenshot'] and not os.path.exists(record['screenshot']):
+                    continue
+                test.outcome, test.screenshot = record['outcome'], record['screenshot']
+                test.cached = record['stamp']
+                self.restored += 1
+            yield rule
+
+    def test_done(self, page, rule, test, spans):
+        """ Append a test that has been run """
+        record = {'key': test_key(rule, test),
+                  'page': page,
+                  'rule': rule.name,
+                  'test': test.test_id,
+                  'outcome': test.outcome,
+                  'screenshot': test.screenshot,
+                  'stamp': time.time()}
+        line = json.dumps(record) + "\n"
+        with self.lock:
+            self.file.write(line)
+            self.file.flush()
+
+    def close(self):
+        self.file.close()
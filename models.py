@@ -1,68 +1,207 @@
 import os
-import sys
+import json
 import time
-import xlrd
-from selenium import webdriver
-from selenium.webdriver.common.keys import Keys
-from selenium.common.exceptions import NoSuchElementException
-from pyvirtualdisplay import Display
+import shutil
+import hashlib
+import multiprocessing
+from collections import OrderedDict
+import threading
+import Queue
+from contextlib import contextmanager
 
-from reportlab.lib.units import inch
-from reports import Report
+# selenium and reportlab take seconds to import; they are imported
+# where they are needed (see browser.py and the report methods)
+from expression import compile_expression, Unsupported
+from readers import script_rows, find_script, find_scripts
+import timings
+from timings import Span
+
+# Guards the counters of rules and pages, which are updated by worker threads
+_counts_lock = threading.Lock()
 
-from settings import OC
 
 class Rule(object):
     """ Simple definition of a rule.
-        It has a name, a description and a list of tests.
+        It has a name, a description, an expression and a list of tests.
+        'fires_when' is the value of the expression for which the actions
+        of the rule fire (True or False), None if the script does not say.
+
+        The rule counts its failed, run and cached tests as their outcomes
+        come in, and passes the changes on to the PageSummary of its page.
     """
-    def __init__(self, name, description):
+    __slots__ = ('name', 'description', 'expression', 'fires_when', 'tests', 'page',
+                 'nr_failed', 'nr_run', 'nr_cached', '_failed')
+
+    def __init__(self, name, description, expression="", fires_when=None):
         self.name = name
         self.description = description
+        self.expression = expression
+        self.fires_when = fires_when
         self.tests = []
+        self.page = None
+        self.nr_failed = 0
+        self.nr_run = 0
+        self.nr_cached = 0
+        # failed tests, in the order in which they failed
+        self._failed = OrderedDict()
+
+    def __getstate__(self):
+        # the page is left out, it would drag all other rules along
+        return dict((name, getattr(self, name)) for name in self.__slots__ if name != 'page')
+
+    def __setstate__(self, state):
+        self.page = None
+        for name, value in state.items():
+            setattr(self, name, value)
 
     def add_test(self, test):
         """ Add a new test to the list of test for this rule """
         self.tests.append(test)
+        test._owner = self
+        if self.page is not None:
+            with _counts_lock:
+                self.page.tests += 1
+        # a new test counts as passed, not run and not cached until updated
+        self.update_counts(test, (True, False, False), test.state())
+
+    def update_counts(self, test, before, after):
+        """ Update the counters after the state of a test has changed
+
+            'before' and 'after' are (passed, run, cached) tuples.
+        """
+        with _counts_lock:
+            was_valid = self.nr_failed == 0
+            if before[0] != after[0]:
+                if after[0]:
+                    self.nr_failed -= 1
+                    self._failed.pop(test, None)
+                else:
+                    self.nr_failed += 1
+                    self._failed[test] = None
+            self.nr_run += after[1] - before[1]
+            self.nr_cached += after[2] - before[2]
+            if self.page is not None:
+                self.page.update(self, before, after, was_valid)
+
+    def pending_tests(self):
+        """ Tests that still have to be run, i.e. have no cached or offline result """
+        return [test for test in self.tests if not (test.cached or test.offline)]
+
+    def offline_outcomes(self, tests, fires_when=None):
+        """ Outcomes of 'tests' computed from the rule expression, in one batch
+
+            The actions of the rule are taken to fire when the expression
+            evaluates to 'fires_when', by default the one of the rule.
+            Returns "Fires", "FiresNot", or None for a test the evaluator
+            cannot handle, per test; all None if it is not known when
+            the actions fire.
+        """
+        if fires_when is None:
+            fires_when = self.fires_when
+        if fires_when is None:
+            return [None] * len(tests)
+        try:
+            expression = compile_expression(self.expression)
+        except Unsupported:
+            return [None] * len(tests)
+        results = expression.evaluate_all([test.test_values for test in tests])
+        return [None if result is None else ("Fires" if result == fires_when else "FiresNot")
+                for result in results]
+
+    def evaluate_offline(self, fires_when=None):
+        """ Fill in the outcome of all tests from the rule expression at once
+
+            Tests the evaluator cannot handle are left as they are.
+            Returns the number of tests that got an outcome.
+        """
+        evaluated = 0
+        for test, outcome in zip(self.tests, self.offline_outcomes(self.tests, fires_when)):
+            if outcome is not None:
+                test.outcome = outcome
+                test.offline = True
+                evaluated += 1
+        return evaluated
+
+    def prescreen(self):
+        """ Compare the expected outcome of the pending tests with the
+            outcome computed from the rule expression
+
+            Only OpenClinica decides whether a test passes: the tests are
+            all still run, this only shows early which of them will likely
+            fail. Tests with a generated expected outcome are not checked,
+            they agree with the expression by construction. Returns the
+            number of tests checked, and a list of (test, outcome computed
+            offline) for the tests that disagree.
+        """
+        tests = [test for test in self.pending_tests() if not test.generated]
+        checked = 0
+        disagreements = []
+        for test, outcome in zip(tests, self.offline_outcomes(tests)):
+            if outcome is not None:
+                checked += 1
+                if outcome != test.expected_outcome:
+                    disagreements.append((test, outcome))
+        return checked, disagreements
 
     def validate(self, browser):
         """ Run all the tests for this rule """
         print str(self.name)
-        for test in self.tests:
+        tests = self.pending_tests()
+        if not tests:
+            return
+        browser.start_rule(self.name)
+        for test in tests:
             test.run_test(browser)
+        browser.end_rule()
+        print "  %d of %d tests passed" % (len(self.tests) - self.nr_failed, len(self.tests))
+        if self.page is not None:
+            print "  page: %s" % self.page.progress()
 
     def is_valid(self):
         """ If all tests pass, the rule is valid """
-        valid = True
-        for test in self.tests:
-            if not test.passed():
-                valid = False
-                break
-        return valid
+        return self.nr_failed == 0
 
     def nr_failed_tests(self):
         """ Get the number of failed tests """
-        fails = 0
-        for test in self.tests:
-            if not test.passed():
-                fails += 1
-        return fails
+        return self.nr_failed
 
     def get_failed_tests(self):
         """ Return a list of test id's that have not passed """
-        failed = []
+        return [str(test) for test in self._failed]
+
+    def report_name(self):
+        """ File name of the report, without extension """
+        if self.is_valid():
+            return self.name
+        return "INVALID_%s" % self.name
+
+    def fingerprint(self):
+        """ Hash of everything that ends up in the report of this rule """
+        content = [self.name, self.description, self.expression]
         for test in self.tests:
-            if not test.passed():
-                failed.append(str(test))
-        return failed
+            content.append((test.test_id, sorted(test.test_values.items()),
+                            test.expected_outcome, test.outcome, test.cached,
+                            test.offline, test.generated, test.screenshot))
+            if test.screenshot and os.path.exists(test.screenshot):
+                stat = os.stat(test.screenshot)
+                content.append((stat.st_size, stat.st_mtime))
+        return hashlib.sha1(repr(content)).hexdigest()
 
     def create_report(self, report_path):
         """ Create a pdf with the validation result for this rule """
-        if self.is_valid():
-            report_name = self.name
-        else:
-            report_name = "INVALID_%s" % self.name
-        report = Report("%s/%s.pdf" % (report_path, report_name))
+        from reports import Report
+        report = Report("%s/%s.pdf" % (report_path, self.report_name()))
+        self.write_report(report)
+        report.save()
+
+    def write_report(self, report):
+        """ Add the validation result for this rule to 'report'
+
+            Every test gets a bookmark, and the rule one that is in the
+            table of contents of a merged report (see create_page_report).
+        """
+        from reportlab.lib.units import inch
+        report.add_bookmark(self.name, self.report_name(), 0, numbered=True)
         report.add_text("Validation Report - %s" % self.name, 18, 'Center')
         report.add_spacer()
         report.add_line()
@@ -87,6 +226,8 @@ class Rule(object):
             else:
                 result = "FAILED"
             report.add_new_page()
+            report.add_bookmark("%s/%s" % (self.name, test.test_id),
+                                "Test %s - %s" % (test.test_id, result), 1)
             report.header("Rule: %s - Test: %s - %s" % (self.name, test.test_id, result))
             report.add_text("Test values used:")
 
@@ -111,13 +252,19 @@ class Rule(object):
                 outcome = "Undefinied"
 
             report.add_text("Expected result: %s" % exp_out)
+            if test.generated:
+                report.add_text("Expected result generated from the rule expression")
             report.add_text("Actual result: %s" % outcome)
+            if test.cached:
+                report.add_text("Result reused from the run of %s" %
+                                time.strftime("%Y-%m-%d %H:%M", time.localtime(test.cached)))
+            if test.offline:
+                report.add_text("Result computed offline from the rule expression")
             report.add_spacer()
             if test.screenshot:
                 report.add_image(test.screenshot)
             else:
                 report.add_text("No screenshot yet")
-        report.save()
 
     def __unicode__(self):
         return self.name
@@ -126,19 +273,114 @@ class Rule(object):
         return self.name
 
 
+class Outcome(object):
+    """ Outcomes of a test, stored as small integers """
+    NOT_RUN, UNDEF, FIRES, FIRES_NOT = range(4)
+    NAMES = ("", "Undef", "Fires", "FiresNot")
+    CODES = dict((name, code) for code, name in enumerate(NAMES))
+
+    @classmethod
+    def code(cls, name):
+        """ Code of an outcome. Unknown outcomes (typos in a script) stay as they are """
+        return cls.CODES.get(name, name)
+
+    @classmethod
+    def name(cls, code):
+        """ Name of an outcome, as used in the scripts and by OpenClinica """
+        if isinstance(code, int):
+            return cls.NAMES[code]
+        return code
+
+
+# Item keys and tuples of item keys, shared by all tests that use them
+_item_keys = {}
+
+
+def intern_keys(keys):
+    """ Return one shared tuple for every distinct sequence of item keys """
+    keys = tuple(_item_keys.setdefault(key, key) for key in keys)
+    return _item_keys.setdefault(keys, keys)
+
+
 class Test(object):
-    """ Test holds the test values for a rule as defined in the Excel scripts """
-    def __init__(self, test_id, rule, expected_outcome, test_values=[]):
+    """ Test holds the test values for a rule as defined in the Excel scripts
+
+        The item keys of a test are a tuple that is shared with all
+        tests with the same items, the values are a tuple of their own.
+        Outcomes are stored as Outcome codes.
+    """
+    __slots__ = ('test_id', 'rule', 'screenshot', 'offline', 'generated', '_owner',
+                 '_cached', '_expected', '_outcome', '_keys', '_values')
+
+    def __init__(self, test_id, rule, expected_outcome, test_values=None):
+        # the Rule object this test has been added to
+        self._owner = None
         self.test_id = test_id
         self.rule = rule
         self.expected_outcome = expected_outcome
-        self.test_values = test_values
+        self.test_values = test_values or ()
         self.outcome = ""
         self.screenshot = ""
+        self.cached = 0
+        # outcome computed from the rule expression instead of in OpenClinica
+        self.offline = False
+        # expected outcome computed from the rule expression (extract_rules.py)
+        self.generated = False
+
+    @property
+    def test_values(self):
+        """ Item keys and values, in the order of the script """
+        return OrderedDict(zip(self._keys, self._values))
+
+    @test_values.setter
+    def test_values(self, test_values):
+        """ Set the values from a dictionary or a sequence of (key, value) pairs """
+        if isinstance(test_values, dict):
+            test_values = test_values.items()
+        self._keys = intern_keys([key for key, value in test_values])
+        self._values = tuple([value for key, value in test_values])
+
+    def state(self):
+        """ (passed, run, cached) of this test, as counted by its rule """
+        return (self.passed(), self._outcome != Outcome.NOT_RUN, bool(self._cached))
+
+    def _set(self, name, value):
+        """ Set an attribute, and let the rule update its counters """
+        if self._owner is None:
+            setattr(self, name, value)
+        else:
+            before = self.state()
+            setattr(self, name, value)
+            self._owner.update_counts(self, before, self.state())
+
+    @property
+    def expected_outcome(self):
+        return Outcome.name(self._expected)
+
+    @expected_outcome.setter
+    def expected_outcome(self, outcome):
+        self._set('_expected', Outcome.code(outcome))
+
+    @property
+    def outcome(self):
+        return Outcome.name(self._outcome)
+
+    @outcome.setter
+    def outcome(self, outcome):
+        self._set('_outcome', Outcome.code(outcome))
+
+    @property
+    def cached(self):
+        """ Time of the earlier run the outcome was taken from, 0 if fresh """
+        return self._cached
+
+    @cached.setter
+    def cached(self, stamp):
+        self._set('_cached', stamp)
 
     def passed(self):
         """ Determine of test passes. """
-        return self.expected_outcome == self.outcome
+        return self._expected == self._outcome
 
     def run_test(self, browser):
         """ Run this test in an established browser session.
@@ -147,6 +389,9 @@ class Test(object):
             of the result.
         """
         self.outcome, self.screenshot = browser.run_test(self)
+        rule = self._owner
+        if rule is not None and rule.page is not None:
+            rule.page.test_done(rule, self, browser.last_timings)
 
     def __unicode__(self):
         return unicode(self.test_id)
@@ -155,114 +400,325 @@ class Test(object):
         return self.test_id
 
 
-class Browser(object):
-    """ Holds a selenium Firefox browser session for testing """
+def format_value(value):
+    """ Excel stores numbers as floats. Convert to integer if needed """
+    parts = str(value).split('.')
+    try:
+        if parts[1] == '0':
+            return parts[0]
+    except IndexError:
+        pass
+    return value
+
+
+class LoginError(Exception):
+    """ Logging in to OpenClinica, or changing to the study, failed """
+    pass
+
+
+class BaseBrowser(object):
+    """ What all ways of running tests in OpenClinica have in common
+
+        Subclasses log in, open the TestRule form of a rule (open_rule)
+        and run a single test on the open form (_run_test). To be
+        restarted after a crash or an expired session, they remember
+        how they logged in, and can start a new session (start) and
+        check the current one (alive).
+    """
     def __init__(self, url, path):
-        """ Starts a browser session with the
-            OpenClinica instance defined in 'url'
-        """
-        if os.uname()[0] == 'Linux':
-            self.display = Display(visible=0, size=(800, 600))
-            self.display.start()
-        self.session = webdriver.Firefox()
-        self.session.implicitly_wait(15)
         self.url = url
         self.screenshot_path = path
+        # (user, password) and study of the last login, for restarts
+        self.credentials = None
+        self.study = None
+        # rule of which the TestRule form is currently open
+        self.rule = None
+        self.filled = set()
+        # (phase, start, seconds) of the current test, and of the last test run
+        self.timings = []
+        self.last_timings = []
 
-    def login(self, user, password):
-        """ Login to the OpenClinica instance """
+    def rule_page(self, rule_name):
+        """ Url of the ViewRuleAssignment page filtered on one rule """
+        scope = "?module=admin&maxRows=15&showMoreLink=true&\
+                ruleAssignments_tr_=true&ruleAssignments_p_=1&\
+                ruleAssignments_mr_=15&ruleAssignments_f_ruleName="
+        return "%s%s%s%s" % (self.url, "ViewRuleAssignment", scope, rule_name)
+
+    @contextmanager
+    def phase(self, name):
+        """ Time a phase of the current test """
+        start = time.time()
         try:
-            self.session.get(self.url)
-            self.session.find_element_by_name("j_username").send_keys(user)
-            self.session.find_element_by_name("j_password").send_keys(password)
-            self.session.find_element_by_name("submit").click()
-        except:
-            print "Unable to log in"
-            sys.exit(1)
+            yield
+        finally:
+            self.timings.append((name, start, time.time() - start))
 
-    def set_study(self, study):
-        """ Change (if needed) to the study we want to use """
-        # first see if we are already at the right study
-        xpath_expr = "//div[@id='StudyInfo']/b/a"
-        elem = self.session.find_element_by_xpath(xpath_expr)
-        # if not, change the study
-        if elem.text != study:
-            self.session.find_element_by_link_text('Change Study/Site').click()
-            try:
-                xpath_expr = "//td/b[contains(text(),'%s')]/../input[@name='studyId']" % study
-                self.session.find_element_by_xpath(xpath_expr).click()
-                self.session.find_element_by_xpath(xpath_expr).click()
-                self.session.find_element_by_name("Submit").click()
-                self.session.find_element_by_name("Submit").click()
-            except NoSuchElementException:
-                print "Study not found!"
-                sys.exit(1)
+    def validate(self, rules):
+        """ Run the tests of all rules, one after another """
+        for rule in rules:
+            rule.validate(self)
 
-    def close(self):
-        """ Close browser and display """
-        self.session.close()
-        if os.uname() == 'Linux':
-            self.display.stop()
+    def start_rule(self, rule_name):
+        """ Open the TestRule form once for all tests of a rule """
+        self.open_rule(rule_name)
+
+    def end_rule(self):
+        """ Leave the TestRule form of the current rule """
+        self.rule = None
+        self.filled = set()
+
+    def alive(self):
+        """ Check if the session still works and is logged in """
+        return True
+
+    def restart(self):
+        """ Start a new session, and log in to the same study again
+
+            Raises LoginError if that fails.
+        """
+        try:
+            self.close()
+        except Exception:
+            pass
+        self.rule = None
+        self.filled = set()
+        self.start()
+        self.login(*self.credentials)
+        if self.study is not None:
+            self.set_study(self.study)
+
+    def try_run_test(self, test):
+        """ _run_test, with ('Undef', '') if it raises """
+        try:
+            return self._run_test(test)
+        except Exception as e:
+            print "    %s: %s: %s" % (test.test_id, e.__class__.__name__, e)
+            self.rule = None
+            return 'Undef', ''
 
     def run_test(self, test):
         """ Runs one test for a rule in OpenClinica
             Input:  Test object and browser session
             Output: Result of running the test, and a path to
                     the screenshot of the result
+
+            If the TestRule form of the rule is already open (see
+            start_rule), only the item values are replaced before the
+            form is submitted again. The time spent per phase is printed,
+            and kept in last_timings. An undefined result is checked
+            for a lost session; the session is then restarted, and the
+            test run once more. A test that raises (the browser has
+            crashed halfway) counts as undefined.
         """
+        result = self.try_run_test(test)
+        if result[0] == 'Undef' and self.credentials is not None and not self.alive():
+            # the browser crashed or the session expired, not the test
+            print "    %s: session lost, restarting" % test.test_id
+            self.restart()
+            result = self.try_run_test(test)
+        self.last_timings, self.timings = self.timings, []
+        print "    %s: %s (%s)" % (test.test_id, result[0],
+                ", ".join(["%s %.2fs" % (name, seconds)
+                           for name, start, seconds in self.last_timings]))
+        return result
 
-        scope = "?module=admin&maxRows=15&showMoreLink=true&\
-                ruleAssignments_tr_=true&ruleAssignments_p_=1&\
-                ruleAssignments_mr_=15&ruleAssignments_f_ruleName="
-        rule_page = "%s%s%s%s" % (self.url, "ViewRuleAssignment", scope, test.rule)
-        self.session.get(rule_page)
-        screenshot = '%s/screenshot_%s.png' % (self.screenshot_path, test.test_id)
-        # test if rule is found
-        try:
-            test_button = self.session.find_elements_by_xpath(
-                    "//a[contains(@href, 'TestRule')]")
-            test_button[1].click()
-            self.session.find_elements_by_xpath(
-                    "//input[@value='Validate & Test']")[0].click()
-        except:
-            self.session.save_screenshot(screenshot)
-            return 'Undef', screenshot
-        # Write values to test items
-        for k, v in test.test_values.items():
-            try:
-                self.session.find_element_by_id(k).clear()
-            except:
-                self.session.save_screenshot(screenshot)
-                return 'Undef', screenshot
-            # Excel stores numbers as floats. Convert to integer if needed
-            parts = str(v).split('.')
-            try:
-                if parts[1] == '0':
-                    v = parts[0]
-            except IndexError:
-                pass
+
+class BrowserPool(object):
+    """ A pool of browser sessions that validate rules in parallel
+
+        Every browser has its own virtual display and OpenClinica session.
+        Rules are put on a shared queue, and each worker thread takes
+        the next rule as soon as it has finished the previous one.
+        'backend' is the class of the sessions, Browser (the default)
+        or HttpBrowser.
+    """
+    def __init__(self, url, path, size, backend=None):
+        if backend is None:
+            from browser import Browser as backend
+        self.browsers = [backend(url, path) for _ in range(size)]
+
+    def login(self, user, password):
+        """ Login all browsers to the OpenClinica instance """
+        for browser in self.browsers:
+            browser.login(user, password)
+
+    def set_study(self, study):
+        """ Change all browsers to the study we want to use """
+        for browser in self.browsers:
+            browser.set_study(study)
+
+    def close(self):
+        """ Close all browsers and displays """
+        for browser in self.browsers:
+            browser.close()
+
+    def validate(self, rules):
+        """ Run the tests of all rules, spread over the browsers
+
+            The workers start right away, and take rules from the
+            queue while 'rules' is still being read.
+        """
+        queue = Queue.Queue(maxsize=2*len(self.browsers))
+        workers = [threading.Thread(target=self._work, args=(browser, queue))
+                   for browser in self.browsers]
+        for worker in workers:
+            worker.daemon = True
+            worker.start()
+        for rule in rules:
+            queue.put(rule)
+        # one stop sign per worker
+        for worker in workers:
+            queue.put(None)
+        for worker in workers:
+            worker.join()
+
+    def _work(self, browser, queue):
+        """ Worker loop: validate rules until the stop sign """
+        while True:
+            rule = queue.get()
+            if rule is None:
+                return
             try:
-                self.session.find_element_by_id(k).send_keys(v)
-            except:
-                self.session.save_screenshot(screenshot)
-                return 'Undef', screenshot
-        try:
-            self.session.find_elements_by_xpath(
-                    "//input[@value='Validate & Test']")[0].click()
-            self.session.save_screenshot(screenshot)
-            action = self.session.find_elements_by_xpath(
-                    "//*[contains(text(), 'Actions Fired')]/following-sibling::td")
-
-            if action[0].text == 'N':
-                result = "FiresNot"
-            elif action[0].text == 'Y':
-                result = "Fires"    
+                rule.validate(browser)
+            except Exception as e:
+                print "Validation of %s aborted: %s" % (rule, e)
+
+
+class PageSummary(object):
+    """ Counters of the rules and tests of one page (test script)
+
+        Kept up to date by the rules of the page as outcomes come in,
+        so the summary of a run is available at any moment. The time
+        spent per phase of every test that is run is kept as Spans.
+    """
+    def __init__(self, name=None, listeners=()):
+        self.name = name
+        # objects with a test_done(page, rule, test, spans) method, that
+        # are told about every test that has been run
+        self.listeners = listeners
+        self.rules = 0
+        self.tests = 0
+        self.valid_rules = 0
+        self.failed_tests = 0
+        self.run_tests = 0
+        self.cached_tests = 0
+        # rules that are not valid, in the order in which they failed
+        self.failed_rules = OrderedDict()
+        self.spans = []
+
+    def add_rule(self, rule):
+        """ Add a rule, and its tests, to the counters """
+        with _counts_lock:
+            rule.page = self
+            self.rules += 1
+            self.tests += len(rule.tests)
+            self.failed_tests += rule.nr_failed
+            self.run_tests += rule.nr_run
+            self.cached_tests += rule.nr_cached
+            if rule.nr_failed == 0:
+                self.valid_rules += 1
             else:
-                result = "Undef"
-        except:
-            self.session.save_screenshot(screenshot)
-            return 'Undef', screenshot
-        return (result, screenshot)
+                self.failed_rules[rule] = None
+
+    def update(self, rule, before, after, was_valid):
+        """ Update the counters after the state of a test of 'rule' has changed """
+        self.failed_tests += before[0] - after[0]
+        self.run_tests += after[1] - before[1]
+        self.cached_tests += after[2] - before[2]
+        is_valid = rule.nr_failed == 0
+        if was_valid and not is_valid:
+            self.valid_rules -= 1
+            self.failed_rules[rule] = None
+        elif is_valid and not was_valid:
+            self.valid_rules += 1
+            self.failed_rules.pop(rule, None)
+
+    def test_done(self, rule, test, phases):
+        """ Keep the (phase, start, seconds) timings of a test that was run,
+            and pass the test on to the listeners
+        """
+        spans = [Span(self.name, rule.name, test.test_id, phase, start, seconds)
+                 for phase, start, seconds in phases]
+        with _counts_lock:
+            self.spans.extend(spans)
+        for listener in self.listeners:
+            listener.test_done(self.name, rule, test, spans)
+
+    def progress(self):
+        """ Short description of how far the tests of this page are """
+        return "%d of %d tests run, %d failed" % (self.run_tests, self.tests, self.failed_tests)
+
+
+# Optional columns of a test script, by title. They come after the
+# expected result, before the items.
+OPTIONAL_COLUMNS = ('fires when', 'generated')
+
+
+def polarity(value):
+    """ True or False for a value of the Fires When or Generated column,
+        None if empty
+    """
+    text = unicode(value).strip().lower()
+    if text in ('', 'none'):
+        return None
+    if text in ('true', 'yes', '1', '1.0'):
+        return True
+    if text in ('false', 'no', '0', '0.0'):
+        return False
+    raise ValueError("expected true or false, not %s" % value)
+
+
+def read_script(filename, sheet=0):
+    """ Reads the rules from a test script (xls, xlsx or csv).
+
+        Each row is read once, and a rule is yielded as soon as the
+        block of rows with its tests has ended. The items start after
+        the optional columns (see OPTIONAL_COLUMNS) that the script has.
+    """
+    rule = None
+    rows = script_rows(filename, sheet)
+    # the first row holds the column titles
+    titles = next(rows, [])
+    columns = {}
+    first_item = 5
+    while (first_item < len(titles) and
+           unicode(titles[first_item]).strip().lower() in OPTIONAL_COLUMNS):
+        columns[unicode(titles[first_item]).strip().lower()] = first_item
+        first_item += 1
+    for row in rows:
+        # blank lines in csv files, empty rows at the end of xlsx sheets
+        if len(row) < 5 or row[1] == '':
+            continue
+        test_vals = []
+        item_counter = first_item
+        while item_counter < len(row):
+            key = row[item_counter]
+            # it seems max number of filled columns is
+            # used, shorter rows have therefore empty keys
+            # and empty keys result in errors..
+            if key != '':
+                try:
+                    test_vals.append((key, row[item_counter+1]))
+                except IndexError:
+                    test_vals.append((key, ""))
+                item_counter += 2
+            else:
+                break
+        rule_name = row[1]
+        if rule is None or rule.name != rule_name:
+            if rule is not None:
+                yield rule
+            fires_when = None
+            if 'fires when' in columns and columns['fires when'] < len(row):
+                fires_when = polarity(row[columns['fires when']])
+            rule = Rule(rule_name, row[2], row[3], fires_when)
+        test = Test(row[0], rule_name, row[4], test_vals)
+        if 'generated' in columns and columns['generated'] < len(row):
+            test.generated = bool(polarity(row[columns['generated']]))
+        rule.add_test(test)
+    if rule is not None:
+        yield rule
 
 
 class TestBattery(object):
@@ -273,101 +729,186 @@ class TestBattery(object):
         page name and rule pairs. Rules have a list of tests that are
         relevant for that rule.
     """
-    def __init__(self, path, scripts=[]):
+    def __init__(self, path, scripts=[], lazy=False, parsed=None):
         """ Initialize TestBattery by loading the test scripts
         
             Get the test scripts either from the parameter if available
-            or find all the Excel sheets with tests in the specified folder (path)
+            or find all the test scripts (xls, xlsx or csv) in the specified
+            folder (path). Script names may be given without extension.
+            If 'lazy' is set, the scripts are only read while the rules
+            are iterated over (see rules), so validation can start
+            before the last script has been read.
+            'parsed' is an optional ScriptCache, which saves parsing
+            scripts that have not changed since an earlier run.
         """
         self.tests = {}
+        self.pages = {}
+        self.parsed = parsed
+        # told about every test that has been run (see PageSummary)
+        self.listeners = []
+        # tests checked offline in the last validation, and the
+        # (rule, test, outcome computed offline) of those that disagree
+        self.checked = 0
+        self.disagreements = []
         if scripts != []:
-            test_scripts = sorted(scripts)
+            self.unread = []
+            for page in sorted(scripts):
+                filename = find_script(path, page)
+                if filename is None:
+                    print "Test script %s not found in %s" % (page, path)
+                    continue
+                page = os.path.splitext(os.path.basename(filename))[0]
+                self.unread.append((page, filename))
         else:
-            test_scripts = sorted([file.split(".")[0] for file in os.listdir(path) if file.split(".")[1].lower()=="xls"])
-        for page in test_scripts:
-            self.load_script(page, "%s/%s.xls" % (path, page))    
-    
-    def load_script(self, page, xlfile, sheet=0):
-        """ Loads tests from an Excel sheet.
+            self.unread = find_scripts(path)
+        if not lazy:
+            for page, filename in self.unread:
+                self.load_script(page, filename)
+            self.unread = []
+
+    def load_script(self, page, filename, sheet=0):
+        """ Loads tests from a test script (xls, xlsx or csv).
         
             Rule objects are created, and tests are added to them.
             Returns a list of rules.
         """
-        rule_list = []
-        rules = xlrd.open_workbook(xlfile).sheet_by_index(sheet)
-        rule_name = ""
-        
-        for rownum in range(rules.nrows)[1:]:
-            test_vals = {}
-            item_counter = 5
-            while item_counter < len(rules.row_values(rownum)):
-                key = rules.row_values(rownum)[item_counter]
-                # it seems max number of filled columns is
-                # used, shorter rows have therefore empty keys
-                # and empty keys result in errors..
-                if key != '':
-                    test_vals[key] = ""
-                    try:
-                        val = rules.row_values(rownum)[item_counter+1]
-                        test_vals[key] = val
-                    except IndexError:
-                        pass
-                    item_counter += 2
-                else:
-                    break
-            test_name = rules.row_values(rownum)[1]
-            if rule_name != test_name:
-                if rule_name != "":
-                    rule_list.append(rule)
-                rule_name = test_name
-                rule_descr = rules.row_values(rownum)[2]
-                rule = Rule(rule_name, rule_descr)
-            test_id = rules.row_values(rownum)[0] 
-            test_exp_outcome = rules.row_values(rownum)[4]
-            rule.add_test(Test(test_id, rule_name, test_exp_outcome, test_vals))
-            # testdata_ordered = sorted(testdata_list, key=lambda test_data: test_id)
-        rule_list.append(rule)
+        rule_list = list(self.read(filename, sheet))
         self.tests[page] = rule_list
-    
-    def validate(self, browser):
-        """ Validate all test in the battery """
-        for test in sorted(self.tests.values()):
-            for rule in test:
-                rule.validate(browser)
+        self.pages[page] = PageSummary(page, self.listeners)
+        for rule in rule_list:
+            self.pages[page].add_rule(rule)
+        return rule_list
+
+    def read(self, filename, sheet=0):
+        """ The rules of a script, from the ScriptCache if there is one """
+        if self.parsed is None or sheet != 0:
+            return read_script(filename, sheet)
+        return self.parsed.load(filename, read_script)
+
+    def rules(self):
+        """ All rules in the battery, page by page
+
+            Scripts that have not been read yet are read on the fly, and
+            their rules are handed out as soon as they are complete.
+        """
+        for page in sorted(self.tests):
+            for rule in self.tests[page]:
+                yield rule
+        while self.unread:
+            page, filename = self.unread.pop(0)
+            rule_list = self.tests[page] = []
+            summary = self.pages[page] = PageSummary(page, self.listeners)
+            for rule in self.read(filename):
+                rule_list.append(rule)
+                summary.add_rule(rule)
+                yield rule
+
+    def schedule(self, scheduler):
+        """ Keep only the rules that 'scheduler' selects (the rules of its
+            shard), and return them in the order to run them
+
+            All scripts are read first.
+        """
+        selected = scheduler.select(self.rules())
+        if scheduler.shard is not None:
+            keep = set(selected)
+            for page in self.tests.keys():
+                rule_list = [rule for rule in self.tests[page] if rule in keep]
+                if not rule_list:
+                    del self.tests[page], self.pages[page]
+                    continue
+                self.tests[page] = rule_list
+                self.pages[page] = PageSummary(page, self.listeners)
+                for rule in rule_list:
+                    self.pages[page].add_rule(rule)
+        return scheduler.order(selected)
+
+    def validate(self, browser, cache=None, max_age=None, offline=False, journal=None,
+                 order=None):
+        """ Validate all test in the battery
+
+            browser is either a single Browser or a BrowserPool
+            Tests with a result in 'cache' (a ResultCache) of at most
+            'max_age' hours old are not run again. If 'offline' is set,
+            the tests are first checked locally (see prescreening), and
+            the rules with tests that will likely fail are run first.
+            Every test that is run is written to 'journal' (a Journal),
+            and tests already in the journal are not run again.
+            'order' is the list of rules to run, in the order to run them
+            (see schedule); by default all rules are run page by page, as
+            they are read.
+        """
+        if order is None:
+            rules = self.rules()
+        else:
+            rules = iter(order)
+        if journal is not None:
+            self.listeners.append(journal)
+            rules = journal.restoring(rules)
+        if cache is not None:
+            rules = cache.restoring(rules, max_age)
+        if offline:
+            rules = self.prescreening(rules)
+        browser.validate(rules)
+
+    def prescreening(self, rules):
+        """ 'rules', with the ones that have tests that disagree with the
+            rule expression first (see Rule.prescreen)
+
+            All rules are checked before the first one is passed on. The
+            tests checked are counted in self.checked, the disagreements
+            are kept in self.disagreements.
+        """
+        self.checked = 0
+        self.disagreements = []
+        first, rest = [], []
+        for rule in rules:
+            checked, disagreements = rule.prescreen()
+            self.checked += checked
+            self.disagreements.extend((rule, test, outcome) for test, outcome in disagreements)
+            (first if disagreements else rest).append(rule)
+        return iter(first + rest)
                 
     def summary(self):
         """ Overview of rules per page """
         summary_per_page = {}
-        totals = {}
-        for page, rules in self.tests.items():
-            summary_per_page[page] = {'rules': 0,
-                                      'tests': 0,
-                                      'valid_rules': 0,
-                                      'passed_tests': 0,
-                                      'failed_rules': []}
-            test_fail = {}
-            summary_per_page[page]['rules'] = len(rules)
-            for rule in rules:
-                summary_per_page[page]['tests'] += len(rule.tests)
-                if rule.is_valid():
-                    summary_per_page[page]['valid_rules'] += 1
-                else:
-                    summary_per_page[page]['failed_rules'].append(rule)
-                for test in rule.tests:
-                    if test.passed():
-                        summary_per_page[page]['passed_tests'] += 1
+        for page, counts in self.pages.items():
+            summary_per_page[page] = {'rules': counts.rules,
+                                      'tests': counts.tests,
+                                      'valid_rules': counts.valid_rules,
+                                      'passed_tests': counts.tests - counts.failed_tests,
+                                      'cached_tests': counts.cached_tests,
+                                      'failed_rules': list(counts.failed_rules)}
         totals = {'rules': 0,
                   'tests': 0,
                   'valid_rules': 0,
-                  'passed_tests': 0}               
+                  'passed_tests': 0,
+                  'cached_tests': 0}
         for page in summary_per_page:
             totals['rules'] += summary_per_page[page]['rules']
             totals['tests'] += summary_per_page[page]['tests']
             totals['valid_rules'] += summary_per_page[page]['valid_rules']
             totals['passed_tests'] += summary_per_page[page]['passed_tests']
+            totals['cached_tests'] += summary_per_page[page]['cached_tests']
         return summary_per_page, totals
+
+    def progress(self):
+        """ Number of tests run, and number of tests loaded so far """
+        return (sum(counts.run_tests for counts in self.pages.values()),
+                sum(counts.tests for counts in self.pages.values()))
     
-    def summary_report(self, path):
+    def spans(self):
+        """ Timings of all phases of the tests that were run, in order """
+        return sorted((span for counts in self.pages.values() for span in counts.spans),
+                      key=lambda span: span.start)
+
+    def summary_report(self, path, trend=None):
+        """ Create the overview of all pages, with the totals of the runs in
+            'trend' (see History.trend), if any
+        """
+        from reportlab.lib.units import inch
+        from reports import Report
+        from config import OC
         report = Report("%s/%s" % (path, "validation_overview.pdf"))
         report.add_text(OC['STUDY'], 18, 'Center')
         report.add_spacer(0.1*inch)
@@ -389,6 +930,9 @@ class TestBattery(object):
         report.add_text("&nbsp")
         report.add_text("Tests run: %d" % totals['tests'])
         report.add_text("Tests failed: %d" % (totals['tests']-totals['passed_tests']))
+        if totals['cached_tests']:
+            report.add_text("Results reused from earlier runs: %d" % totals['cached_tests'])
+            report.add_text("Results of this run: %d" % (totals['tests']-totals['cached_tests']))
         if totals['tests']-totals['passed_tests']:
             report.add_new_page()
             report.add_text(OC['STUDY'], 14, 'Center')
@@ -402,23 +946,181 @@ class TestBattery(object):
                     for rule in summary_per_page[page]['failed_rules']:
                         report.add_text(", ".join(rule.get_failed_tests()))
                     report.add_text("&nbsp")
+        spans = self.spans()
+        if spans:
+            report.add_new_page()
+            report.add_text(OC['STUDY'], 14, 'Center')
+            report.add_text("Timings", 12, 'Center')
+            report.add_spacer(0.1*inch)
+            report.add_line()
+            report.add_spacer(0.1*inch)
+            report.add_text("Phases:")
+            phases = timings.per_phase(spans)
+            for phase in sorted(phases, key=lambda phase: -phases[phase]['total']):
+                report.add_text("%s%s: %s" % ("&nbsp;"*5, phase, timings.describe(phases[phase])))
+            report.add_text("&nbsp")
+            report.add_text("Tests per page:")
+            pages = timings.per_page(spans)
+            for page in sorted(pages):
+                report.add_text("%s%s: %s" % ("&nbsp;"*5, page, timings.describe(pages[page])))
+            report.add_text("&nbsp")
+            report.add_text("Slowest rules:")
+            for seconds, page, rule, phases in timings.slowest_rules(spans):
+                report.add_text("%s%s / %s: %.2fs (%s)" % (
+                        "&nbsp;"*5, page, rule, seconds,
+                        ", ".join("%s %.2fs" % (phase, phases[phase])
+                                  for phase in sorted(phases, key=phases.get, reverse=True))))
+        if trend:
+            report.add_new_page()
+            report.add_text(OC['STUDY'], 14, 'Center')
+            report.add_text("Trend", 12, 'Center')
+            report.add_spacer(0.1*inch)
+            report.add_line()
+            report.add_spacer(0.1*inch)
+            report.add_text("Results of the last %d runs:" % len(trend))
+            previous = None
+            for run in trend:
+                line = "%s%s: %d of %d tests passed" % (
+                        "&nbsp;"*5, time.strftime("%Y-%m-%d %H:%M", time.localtime(run['started'])),
+                        run['passed'], run['tests'])
+                if run['tests']:
+                    line += " (%3.1f%%)" % (run['passed']/float(run['tests'])*100)
+                if previous is not None and run['passed'] != previous['passed']:
+                    line += ", %+d passed" % (run['passed'] - previous['passed'])
+                report.add_text(line)
+                previous = run
         report.save()
         
-    def create_reports(self, report_path):
-        """ Create all reports for test battery """
-        
-        # Create new folder 
-        try:
-            os.mkdir(report_path)
-        except OSError:
-            pass
-        
-        self.summary_report(report_path)
-        
+    def write_timings(self, report_path):
+        """ Write the timings of the tests that were run to 'report_path' """
+        spans = self.spans()
+        if spans:
+            if not os.path.isdir(report_path):
+                os.makedirs(report_path)
+            timings.write_spans("%s/%s" % (report_path, TIMINGS), spans)
+
+    def create_reports(self, report_path, processes=None, merged=False, trend=None):
+        """ Create all reports for test battery
+
+            The rule reports are rendered in a pool of 'processes' processes
+            (default: one per cpu). A rule whose results have not changed
+            since the previous run in the same root folder gets the report
+            of that run copied instead. If 'merged', every page gets one
+            report with the reports of all its rules (see create_page_report),
+            which is copied when none of them has changed. The overview
+            gets the totals of the runs in 'trend'.
+        """
+        start = time.time()
+        # Create new folder
+        if not os.path.isdir(report_path):
+            os.makedirs(report_path)
+
+        self.summary_report(report_path, trend)
+
+        previous_path, previous = previous_reports(report_path)
+        manifest = {}
+        jobs = []
         for page, rules in self.tests.items():
+            if merged:
+                fingerprint = hashlib.sha1("".join(rule.fingerprint() for rule in rules)).hexdigest()
+                manifest[page] = {'fingerprint': fingerprint, 'file': "%s.pdf" % page}
+                old = previous.get(page)
+                if old and old['fingerprint'] == fingerprint and \
+                        os.path.exists("%s/%s" % (previous_path, old['file'])):
+                    shutil.copy("%s/%s" % (previous_path, old['file']), report_path)
+                else:
+                    jobs.append((page, rules, report_path))
+                continue
             # Create subfolder for page
             output_path = "%s/%s" % (report_path, page)
-            os.mkdir(output_path)
+            if not os.path.isdir(output_path):
+                os.mkdir(output_path)
             for rule in rules:
-                rule.create_report(output_path)
- 
+                key = "%s/%s" % (page, rule.name)
+                fingerprint = rule.fingerprint()
+                manifest[key] = {'fingerprint': fingerprint,
+                                 'file': "%s/%s.pdf" % (page, rule.report_name())}
+                old = previous.get(key)
+                if old and old['fingerprint'] == fingerprint and \
+                        os.path.exists("%s/%s" % (previous_path, old['file'])):
+                    shutil.copy("%s/%s" % (previous_path, old['file']), output_path)
+                else:
+                    jobs.append((rule, output_path))
+        with open("%s/%s" % (report_path, MANIFEST), 'w') as manifest_file:
+            json.dump(manifest, manifest_file, indent=1)
+
+        pool = multiprocessing.Pool(processes)
+        try:
+            for name, seconds in pool.imap_unordered(
+                    _create_page_report if merged else _create_report, jobs):
+                print "Report %s: %.2fs" % (name, seconds)
+        finally:
+            pool.close()
+            pool.join()
+        print "Reports: %d created, %d copied in %.1fs" % (
+                len(jobs), len(manifest) - len(jobs), time.time() - start)
+
+
+# Name of the file in a report folder that lists the fingerprints of the reports
+MANIFEST = "reports.json"
+
+# Name of the file in a report folder with the timings of the tests, as JSON lines
+TIMINGS = "timings.jsonl"
+
+
+def previous_reports(report_path):
+    """ Find the most recent earlier report folder next to 'report_path'
+
+        Returns its path and its manifest, or an empty manifest if there
+        is no earlier folder with one.
+    """
+    root, current = os.path.split(os.path.abspath(report_path))
+    for folder in sorted(os.listdir(root), reverse=True):
+        manifest = os.path.join(root, folder, MANIFEST)
+        if folder != current and os.path.exists(manifest):
+            with open(manifest) as manifest_file:
+                return os.path.join(root, folder), json.load(manifest_file)
+    return None, {}
+
+
+def create_page_report(page, rules, report_path):
+    """ Create one pdf with the reports of all rules of a page
+
+        It starts with the totals and a table of contents, every rule and
+        every test is in the outline. The document is laid out rule by rule.
+    """
+    from reportlab.lib.units import inch
+    from reports import MergedReport
+    report = MergedReport("%s/%s.pdf" % (report_path, page))
+    report.add_text("Validation Report - %s" % page, 18, 'Center')
+    report.add_spacer()
+    report.add_line()
+    report.add_spacer(0.2*inch)
+    valid = sum(1 for rule in rules if rule.is_valid())
+    report.add_text("Validation date: %s" % time.strftime("%Y-%m-%d"))
+    report.add_text("Rules: %d, valid: %d, NOT valid: %d" % (len(rules), valid, len(rules) - valid))
+    report.add_spacer()
+    report.add_text("Contents", 14)
+    report.add_spacer(0.1*inch)
+    report.add_contents([(rule.name, rule.report_name(), 0) for rule in rules])
+    for rule in rules:
+        report.add_new_page()
+        rule.write_report(report)
+        report.flush()
+    report.save()
+
+
+def _create_page_report(job):
+    """ Create the report of one page, in a worker process """
+    page, rules, report_path = job
+    start = time.time()
+    create_page_report(page, rules, report_path)
+    return page, time.time() - start
+
+
+def _create_report(job):
+    """ Create the report of one rule, in a worker process """
+    rule, output_path = job
+    start = time.time()
+    rule.create_report(output_path)
+    return rule.name, time.time() - start
@@ -0,0 +1,103 @@
+import os
+import csv
+import datetime
+
+
+def xls_rows(filename, sheet=0):
+    """ Rows of an Excel 97-2003 sheet, read with xlrd """
+    import xlrd
+    book = xlrd.open_workbook(filename, on_demand=True)
+    try:
+        rows = book.sheet_by_index(sheet)
+        for rownum in xrange(rows.nrows):
+            yield rows.row_values(rownum)
+    finally:
+        book.release_resources()
+
+
+def xlsx_value(value):
+    """ A cell value of openpyxl as xlrd gives it: numbers and dates as
+        floats (dates as Excel serial numbers), booleans as 1 or 0, and
+        empty cells as empty text
+    """
+    from openpyxl.utils.datetime import to_excel, time_to_days, timedelta_to_days
+    if value is None:
+        return u''
+    if isinstance(value, bool):
+        return int(value)
+    if isinstance(value, (int, long)):
+        return float(value)
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return float(to_excel(value))
+    if isinstance(value, datetime.time):
+        return float(time_to_days(value))
+    if isinstance(value, datetime.timedelta):
+        return float(timedelta_to_days(value))
+    return value
+
+
+def xlsx_rows(filename, sheet=0):
+    """ Rows of an Excel 2007+ sheet
+
+        The workbook is opened read-only, so openpyxl streams the
+        rows from the file instead of building the whole workbook.
+        Values are converted to what xls_rows would give (see xlsx_value).
+    """
+    import openpyxl
+    book = openpyxl.load_workbook(filename, read_only=True, data_only=True)
+    try:
+        for row in book.worksheets[sheet].iter_rows():
+            yield [xlsx_value(cell.value) for cell in row]
+    finally:
+        book.close()
+
+
+def csv_rows(filename, sheet=0):
+    """ Rows of a comma separated file in UTF-8
+
+        All values are text, which is fine for the tests: numbers are
+        written to OpenClinica as text anyway (see format_value).
+    """
+    with open(filename, 'rb') as f:
+        for row in csv.reader(f):
+            yield [value.decode('utf-8') for value in row]
+
+
+# Reader per file extension
+READERS = {'.xls': xls_rows,
+           '.xlsx': xlsx_rows,
+           '.csv': csv_rows}
+
+
+def script_rows(filename, sheet=0):
+    """ Rows of a test script, in the format that goes with its extension """
+    extension = os.path.splitext(filename)[1].lower()
+    if extension not in READERS:
+        raise ValueError("Unsupported test script: %s" % filename)
+    return READERS[extension](filename, sheet)
+
+
+def find_script(path, page):
+    """ File name of the test script for a page, None if there is none
+
+        'page' may be given with or without its extension.
+    """
+    name, extension = os.path.splitext(page)
+    if extension.lower() in READERS:
+        filename = os.path.join(path, page)
+        return filename if os.path.isfile(filename) else None
+    for extension in sorted(READERS):
+        filename = os.path.join(path, page + extension)
+        if os.path.isfile(filename):
+            return filename
+    return None
+
+
+def find_scripts(path):
+    """ Pages and file names of all test scripts in a folder """
+    scripts = []
+    for filename in sorted(os.listdir(path)):
+        page, extension = os.path.splitext(filename)
+        if extension.lower() in READERS and not filename.startswith('~$'):
+            scripts.append((page, os.path.join(path, filename)))
+    return scripts
@@ -1,7 +1,7 @@
 import time
 
 from reportlab.lib.pagesizes import letter, A4
-from reportlab.platypus import SimpleDocTemplate, BaseDocTemplate, Image
+from reportlab.platypus import SimpleDocTemplate, BaseDocTemplate, PageTemplate, Image
 
 from reportlab.pdfgen.canvas import Canvas
 from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
@@ -26,15 +26,114 @@ class Line(Flowable):
         """ draw the line """
         self.canv.line(0, self.height, self.width, self.height)
 
+class Bookmark(Flowable):
+    """ Invisible flowable that marks its place for the outline and the contents
+
+        If 'numbered', the page number is written to the form that
+        ContentsLine shows, which can only be filled in at this point.
+    """
+
+    def __init__(self, key, title, level=0, numbered=False):
+        Flowable.__init__(self)
+        self.key = key
+        self.title = title
+        self.level = level
+        self.numbered = numbered
+
+    def wrap(self, availWidth, availHeight):
+        return (0, 0)
+
+    def draw(self):
+        self.canv.bookmarkHorizontal(self.key, 0, 0)
+        self.canv.addOutlineEntry(self.title, self.key, self.level)
+        if self.numbered:
+            page = self.canv.getPageNumber()
+            self.canv.beginForm("page_%s" % self.key)
+            self.canv.setFont('Helvetica', 10)
+            self.canv.drawRightString(0, 0, "%d" % page)
+            self.canv.endForm()
+
+
+class ContentsLine(Flowable):
+    """ A line of the table of contents, linked to a Bookmark
+
+        The page number is a form that the Bookmark fills in later, so the
+        contents can come first without rendering the document twice.
+    """
+
+    def __init__(self, key, title, width, level=0):
+        Flowable.__init__(self)
+        self.key = key
+        self.title = title
+        self.width = width
+        self.level = level
+        self.height = 14
+
+    def draw(self):
+        self.canv.setFont('Helvetica', 10)
+        self.canv.drawString(self.level * 18, 3, self.title)
+        self.canv.saveState()
+        self.canv.translate(self.width, 3)
+        self.canv.doForm("page_%s" % self.key)
+        self.canv.restoreState()
+        self.canv.linkRect("", self.key, (0, 0, self.width, self.height), relative=1)
+
+
+class StreamingDocTemplate(BaseDocTemplate):
+    """ A document that is laid out while the flowables come in
+
+        build needs all flowables at once; here they are handed over in
+        parts (add), and every part is laid out and released right away.
+    """
+
+    def __init__(self, filename, **kw):
+        BaseDocTemplate.__init__(self, filename, **kw)
+        frame = Frame(self.leftMargin, self.bottomMargin, self.width, self.height, id='normal')
+        self.addPageTemplates([PageTemplate(id='Page', frames=frame, pagesize=self.pagesize)])
+        self._startBuild()
+        self.canv._doctemplate = self
+
+    def add(self, flowables):
+        while flowables:
+            self.clean_hanging()
+            self.handle_flowable(flowables)
+
+    def close(self):
+        del self.canv._doctemplate
+        self.canv.showOutline()
+        self._endBuild()
+
+
+# Built once per process, and shared by all reports
+_styles = None
+
+# Sizes of the images in the reports, by file name
+_image_sizes = {}
+
+
+def stylesheet():
+    """ The paragraph styles of the reports """
+    global _styles
+    if _styles is None:
+        _styles = getSampleStyleSheet()
+        _styles.add(ParagraphStyle(name='Center', alignment=TA_CENTER))
+    return _styles
+
+
 class Report(object):
     def __init__(self, filename, size=A4):
-        self.doc = SimpleDocTemplate(filename,pagesize=size,
+        self.doc = self.document(filename, pagesize=size,
                         rightMargin=72,leftMargin=72,
                         topMargin=72,bottomMargin=18)
         self.elements = []
-        self.styles = getSampleStyleSheet()
-        self.styles.add(ParagraphStyle(name='Center', alignment=TA_CENTER))
+        self.image_sizes = _image_sizes
+        self.styles = stylesheet()
         self.width, self.height = size
+        # bookmark names by the names given to add_bookmark
+        self.keys = {}
+
+    def document(self, filename, **kw):
+        return SimpleDocTemplate(filename, **kw)
     
     def add_spacer(self, height=0.25*inch):
         """ Add white space between elements """
@@ -60,9 +159,14 @@ class Report(object):
         self.elements.append(PageBreak())
         
     def add_image(self, filename, height=6*inch):
-        """ Insert an image to the report """
-        img = utils.ImageReader(filename)
-        iw, ih = img.getSize()
+        """ Insert an image to the report
+
+            Screenshots are named after their content, so an image that
+            is used again is only read once, and embedded once in the pdf.
+        """
+        if filename not in self.image_sizes:
+            self.image_sizes[filename] = utils.ImageReader(filename).getSize()
+        iw, ih = self.image_sizes[filename]
         aspect = ih / float(iw)
         self.elements.append(Spacer(self.width, 0.25*inch))
         self.elements.append(Image(filename, width=(height/aspect), height=height))
@@ -86,6 +190,48 @@ class Report(object):
         self.add_line()
         self.add_spacer(0.1*inch)
         
+    def key(self, name):
+        """ Name of a bookmark, that can be used as the name of a pdf form """
+        return self.keys.setdefault(name, "b%d" % len(self.keys))
+
+    def add_bookmark(self, name, title, level=0, numbered=False):
+        """ Bookmark this place, as an entry of the outline at 'level'
+
+            Set 'numbered' if the bookmark is in the table of contents.
+        """
+        self.elements.append(Bookmark(self.key(name), title, level, numbered))
+
+    def flush(self):
+        """ The elements are laid out by save """
+        pass
+
     def save(self):
         self.doc.build(self.elements)
 
+
+class MergedReport(Report):
+    """ Many reports in one document, with an outline and a table of contents
+
+        The elements are laid out each time flush is called (for instance
+        after every rule), so only one part is kept in memory at a time.
+    """
+    def document(self, filename, **kw):
+        return StreamingDocTemplate(filename, **kw)
+
+    def add_contents(self, entries):
+        """ Table of contents of (name, title, level) entries,
+            that link to the bookmarks with the same name
+        """
+        width = self.doc.width
+        for name, title, level in entries:
+            self.elements.append(ContentsLine(self.key(name), title, width, level))
+
+    def flush(self):
+        """ Lay out the elements added so far """
+        self.doc.add(self.elements)
+        self.elements = []
+
+    def save(self):
+        self.flush()
+        self.doc.close()
+
@@ -0,0 +1,111 @@
+import heapq
+from cache import test_key
+
+# Seconds a test is estimated to take when the history knows no better
+DEFAULT_SECONDS = 1.0
+
+# Priorities of rules: lower runs first
+FAILED, CHANGED, UNCHANGED = range(3)
+
+
+def parse_shard(text):
+    """ (number, count) of a shard given as "i/N", with i from 1 to N """
+    try:
+        number, count = [int(part) for part in text.split('/')]
+    except ValueError:
+        raise ValueError("a shard is given as i/N, not %s" % text)
+    if not 1 <= number <= count:
+        raise ValueError("shard %d/%d does not exist" % (number, count))
+    return number, count
+
+
+class Scheduler(object):
+    """ Decides which rules to run, and in what order
+
+        'stats' is what the history knows about the rules (see
+        History.rule_stats). Rules that failed in the last run go first,
+        then rules that are new or have changed since, so failures show
+        up early; these run the quickest first. The other rules run the
+        slowest first, so parallel sessions finish at about the same time.
+
+        With a 'shard' (number, count), the rules are split in 'count'
+        parts of about equal estimated time, and only part 'number' is
+        run. The times are estimated from 'estimates' (by default
+        'stats'). For shards these should be the history as of a run
+        that all shards agree on, as runs of other shards change it;
+        the parts are then the same on every machine.
+
+        If 'in_order', the rules keep the order in which they are given.
+    """
+    def __init__(self, stats=None, shard=None, estimates=None, in_order=False):
+        self.stats = stats or {}
+        self.shard = shard
+        self.estimates = self.stats if estimates is None else estimates
+        self.in_order = in_order
+        durations = [rule_stats['seconds'] for rule_stats in self.estimates.values()
+                     if rule_stats['seconds'] is not None]
+        self.seconds = sum(durations) / len(durations) if durations else DEFAULT_SECONDS
+        # estimated seconds by rule
+        self.costs = {}
+
+    def rule_stats(self, rule, stats=None):
+        if stats is None:
+            stats = self.stats
+        return stats.get((rule.page.name if rule.page is not None else None, rule.name))
+
+    def cost(self, rule):
+        """ Estimated seconds it takes to run all tests of 'rule' """
+        if rule not in self.costs:
+            rule_stats = self.rule_stats(rule, self.estimates)
+            seconds = self.seconds
+            if rule_stats is not None and rule_stats['seconds'] is not None:
+                seconds = rule_stats['seconds']
+            self.costs[rule] = seconds * len(rule.tests)
+        return self.costs[rule]
+
+    def priority(self, rule):
+        """ FAILED, CHANGED or UNCHANGED, according to the last run """
+        if not self.stats:
+            return UNCHANGED
+        rule_stats = self.rule_stats(rule)
+        if rule_stats is None:
+            return CHANGED
+        if rule_stats['failed']:
+            return FAILED
+        for test in rule.tests:
+            if test_key(rule, test) not in rule_stats['keys']:
+                return CHANGED
+        return UNCHANGED
+
+    def shards(self, rules):
+        """ Split 'rules' in parts of about equal estimated time
+
+            The slowest rule goes to the part with the least time so far,
+            and so on. Returns a list of (estimated seconds, rules).
+        """
+        parts = [(0.0, number, []) for number in range(self.shard[1])]
+        for rule in sorted(rules, key=lambda rule: (-self.cost(rule), rule.page.name, rule.name)):
+            seconds, number, part = heapq.heappop(parts)
+            part.append(rule)
+            heapq.heappush(parts, (seconds + self.cost(rule), number, part))
+        return [(seconds, part) for seconds, number, part in sorted(parts, key=lambda x: x[1])]
+
+    def select(self, rules):
+        """ The rules of this shard, in the order they are given;
+            all rules if there are no shards
+        """
+        rules = list(rules)
+        if self.shard is None:
+            return rules
+        keep = set(self.shards(rules)[self.shard[0] - 1][1])
+        return [rule for rule in rules if rule in keep]
+
+    def order(self, rules):
+        """ 'rules' in the order to run them """
+        if self.in_order:
+            return list(rules)
+        def key(rule):
+            priority = self.priority(rule)
+            cost = self.cost(rule) if priority != UNCHANGED else -self.cost(rule)
+            return (priority, cost, rule.page.name, rule.name)
+        return sorted(rules, key=key)
@@ -0,0 +1,42 @@
+import os
+import hashlib
+from cStringIO import StringIO
+
+from PIL import Image
+
+from config import SCREENSHOTS
+
+
+def process(filename, box=None):
+    """ Make a screenshot fit for embedding in a report
+
+        The image is cropped to 'box' (left, upper, right, lower) plus a
+        margin, scaled down to fit SCREENSHOTS['MAX_WIDTH'] x
+        SCREENSHOTS['MAX_HEIGHT'] and saved in SCREENSHOTS['FORMAT'].
+        The result is named after its content, so identical screenshots
+        are stored, and embedded in a report, only once.
+        The original file is removed. Returns the path of the new file.
+    """
+    image = Image.open(filename)
+    if box is not None:
+        margin = SCREENSHOTS['MARGIN']
+        width, height = image.size
+        image = image.crop((max(0, box[0] - margin), max(0, box[1] - margin),
+                            min(width, box[2] + margin), min(height, box[3] + margin)))
+    image.thumbnail((SCREENSHOTS['MAX_WIDTH'], SCREENSHOTS['MAX_HEIGHT']), Image.ANTIALIAS)
+    if SCREENSHOTS['FORMAT'] == 'JPEG':
+        image = image.convert('RGB')
+        extension = 'jpg'
+    else:
+        extension = SCREENSHOTS['FORMAT'].lower()
+    data = StringIO()
+    image.save(data, SCREENSHOTS['FORMAT'], quality=SCREENSHOTS['QUALITY'], optimize=True)
+    data = data.getvalue()
+    target = os.path.join(os.path.dirname(filename),
+                          "%s.%s" % (hashlib.sha1(data).hexdigest(), extension))
+    if not os.path.exists(target):
+        with open(target, 'wb') as image_file:
+            image_file.write(data)
+    if os.path.abspath(target) != os.path.abspath(filename):
+        os.remove(filename)
+    return target
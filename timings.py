@@ -0,0 +1,79 @@
+import json
+import math
+from collections import namedtuple
+
+# How long one phase of one test took. 'start' is a time.time() stamp.
+Span = namedtuple('Span', 'page rule test phase start seconds')
+
+# Percentiles that are reported per phase and per page
+PERCENTILES = (50, 90, 99)
+
+
+def percentile(values, p):
+    """ The p-th percentile of sorted values (nearest rank) """
+    if not values:
+        return 0.0
+    rank = int(math.ceil(p / 100.0 * len(values))) - 1
+    return values[min(max(rank, 0), len(values) - 1)]
+
+
+def statistics(spans, key):
+    """ Count, total, percentiles and maximum of the spans per key(span)
+
+        Returns a dictionary with a dictionary of statistics per key.
+    """
+    groups = {}
+    for span in spans:
+        groups.setdefault(key(span), []).append(span.seconds)
+    result = {}
+    for group, seconds in groups.items():
+        seconds.sort()
+        stats = {'count': len(seconds),
+                 'total': sum(seconds),
+                 'max': seconds[-1]}
+        for p in PERCENTILES:
+            stats['p%d' % p] = percentile(seconds, p)
+        result[group] = stats
+    return result
+
+
+def per_phase(spans):
+    return statistics(spans, lambda span: span.phase)
+
+
+def per_page(spans):
+    """ Statistics of whole tests, per page """
+    tests = {}
+    for span in spans:
+        key = (span.page, span.rule, span.test)
+        tests[key] = tests.get(key, 0.0) + span.seconds
+    return statistics([Span(key[0], key[1], key[2], 'test', 0, seconds)
+                       for key, seconds in tests.items()],
+                      lambda span: span.page)
+
+
+def slowest_rules(spans, number=10):
+    """ The rules that took most time: (seconds, page, rule, seconds per phase) """
+    rules = {}
+    for span in spans:
+        phases = rules.setdefault((span.page, span.rule), {})
+        phases[span.phase] = phases.get(span.phase, 0.0) + span.seconds
+    slowest = sorted(((sum(phases.values()), page, rule, phases)
+                      for (page, rule), phases in rules.items()), reverse=True)
+    return slowest[:number]
+
+
+def describe(stats):
+    """ One line with the statistics of a phase or page """
+    return "%d x, %s, max %.2fs, total %.1fs" % (
+            stats['count'],
+            ", ".join("p%d %.2fs" % (p, stats['p%d' % p]) for p in PERCENTILES),
+            stats['max'], stats['total'])
+
+
+def write_spans(filename, spans):
+    """ Write the spans as JSON lines, one object per span """
+    with open(filename, 'w') as f:
+        for span in spans:
+            f.write(json.dumps(span._asdict()))
+            f.write("\n")
@@ -1,32 +1,383 @@
 #!path/to/python
+import os
 import sys
-from settings import OC, PATHS, TESTSXLS
-from models import Browser, TestBattery
+import time
+import argparse
+from config import PATHS, TESTSXLS
 
-if __name__ == "__main__":
-    """ Validation of OpenClinica rules """
+# Only what a command needs is imported when it runs: selenium, requests
+# and reportlab take seconds to import, parsing scripts takes milliseconds.
+COMMANDS = ('load', 'validate', 'report', 'summary', 'diff')
 
+
+def load_battery(args, lazy=False):
+    """ The test battery of the scripts on the command line, or TESTSXLS """
+    from models import TestBattery
+    from cache import ScriptCache
     # Manual testscript input on command line
     # trumps the list in settings.py
-    if len(sys.argv[1:]) != 0:
-        TESTSXLS = []
-        for script in sys.argv[1:]:
-            TESTSXLS.append(script)
+    return TestBattery(PATHS['TEST_SCRIPTS'], args.scripts or TESTSXLS, lazy,
+                       parsed=ScriptCache(PATHS['PARSED_SCRIPTS']))
+
+
+def restore_results(test_battery, max_age=None):
+    """ Give the tests the outcomes stored by earlier runs """
+    from cache import ResultCache
+    cache = ResultCache(PATHS['RESULTS'])
+    restored = cache.restore(test_battery.rules(), max_age)
+    cache.close()
+    return restored
+
+
+def print_summary(test_battery):
+    """ Print the rules and tests per page, and the totals """
+    summary_per_page, totals = test_battery.summary()
+    for page in sorted(summary_per_page):
+        counts = summary_per_page[page]
+        print "%s: %d of %d rules valid, %d of %d tests passed" % (
+                page, counts['valid_rules'], counts['rules'],
+                counts['passed_tests'], counts['tests'])
+    print "Total: %d of %d rules valid, %d of %d tests passed, %d reused" % (
+            totals['valid_rules'], totals['rules'],
+            totals['passed_tests'], totals['tests'], totals['cached_tests'])
+
+
+def print_disagreements(test_battery):
+    """ Print the tests whose expected outcome disagrees with the rule expression """
+    print "Checked %d tests offline, %d disagree with the rule expression" % (
+            test_battery.checked, len(test_battery.disagreements))
+    for rule, test, outcome in test_battery.disagreements:
+        print "  %s: expected %s, the expression gives %s" % (test.test_id,
+                                                              test.expected_outcome, outcome)
+
+
+def load(args):
+    """ Read the test scripts without running anything """
+    test_battery = load_battery(args)
+    for page in sorted(test_battery.tests):
+        rules = test_battery.tests[page]
+        print "%s: %d rules, %d tests" % (page, len(rules),
+                                          sum(len(rule.tests) for rule in rules))
+    if args.offline:
+        for rule in test_battery.prescreening(test_battery.rules()):
+            pass
+        print_disagreements(test_battery)
+
+
+def new_run(shard=None):
+    """ Name of a new run: the time it started, to the microsecond, and
+        the shard (number, count) if it runs one. Shards that start at the
+        same time on other machines get runs, and journals, of their own.
+    """
+    now = time.time()
+    run = "%s_%06d" % (time.strftime("%Y_%m_%d_%H_%M_%S", time.localtime(now)),
+                       int(now % 1 * 1000000))
+    if shard is not None:
+        run += "_shard%dof%d" % shard
+    return run
+
+
+def open_journal(run, resume=False):
+    """ The journal of a new run, or of the run to resume """
+    from journal import Journal
+    if not os.path.isdir(PATHS['JOURNALS']):
+        os.makedirs(PATHS['JOURNALS'])
+    filename = os.path.join(PATHS['JOURNALS'], "%s.jsonl" % run)
+    if resume and not os.path.exists(filename):
+        print "No journal of run %s in %s" % (run, PATHS['JOURNALS'])
+        sys.exit(1)
+    print "Journal of this run: %s (resume with --resume %s)" % (filename, run)
+    return Journal(filename)
+
+
+def add_exporters(test_battery, formats, run, validated=True, shard=None, resume=False):
+    """ Export the results of every test as it is done (see exporters.py) """
+    from exporters import create_exporters
+    exporters = create_exporters(formats, PATHS['REPORTS'], PATHS['HISTORY'], run,
+                                 validated, shard, resume)
+    test_battery.listeners.extend(exporters)
+    return exporters
+
+
+def finish(test_battery, exporters, pdf=True, merged=False):
+    """ Export the tests that were not run, write the timings, and create
+        the PDF reports
+    """
+    for exporter in exporters:
+        exporter.finish(test_battery.rules())
+    test_battery.write_timings(PATHS['REPORTS'])
+    if pdf:
+        trend = None
+        if os.path.exists(PATHS['HISTORY']):
+            from history import History
+            history = History(PATHS['HISTORY'])
+            trend = history.trend()
+            history.close()
+        test_battery.create_reports(PATHS['REPORTS'], merged=merged, trend=trend)
+
+
+def create_scheduler(args):
+    """ A scheduler with what the history knows about the rules, or None
+        to run the rules in the order of the scripts
+    """
+    from scheduler import Scheduler
+    if args.in_order and args.shard is None:
+        return None
+    stats, estimates = {}, {}
+    if os.path.exists(PATHS['HISTORY']):
+        from history import History
+        history = History(PATHS['HISTORY'])
+        if not args.in_order:
+            stats = history.rule_stats()
+        if args.shard is not None:
+            # all shards split as of the same run, whatever the others
+            # have added to the history since
+            base = args.shard_base or history.latest()
+            if args.shard_base and args.shard_base not in history.runs():
+                print "No run %s in the history" % args.shard_base
+                sys.exit(1)
+            if base is not None:
+                print "Shards as of run %s" % base
+                estimates = history.rule_stats(until=base)
+        history.close()
+    if not stats and args.shard is None:
+        return None
+    return Scheduler(stats, args.shard, estimates if args.shard else None, args.in_order)
+
+
+def print_schedule(scheduler, rules):
+    """ Print what goes first, and the estimated time of the shard """
+    from scheduler import FAILED, CHANGED
+    priorities = [scheduler.priority(rule) for rule in rules]
+    print "Running first: %d rules that failed in the last run, %d new or changed rules" % (
+            priorities.count(FAILED), priorities.count(CHANGED))
+    if scheduler.shard is not None:
+        print "Shard %d/%d: %d rules, about %.1fs" % (
+                scheduler.shard[0], scheduler.shard[1], len(rules),
+                sum(scheduler.cost(rule) for rule in rules))
+
+
+def validate(args):
+    """ Run the tests in OpenClinica and create the reports """
+    from config import OC, ENGINE
+    from cache import ResultCache
+    from models import LoginError
+
+    if args.backend == 'http':
+        from httpbrowser import HttpBrowser as backend
+    elif args.backend == 'selenium':
+        from browser import Browser as backend
 
     # Create a browser session and login
-    browser = Browser(OC['URL'], PATHS['SCREENSHOTS'] )
-    browser.login(OC['USER'], OC['PWD'])
-    browser.set_study(OC['STUDY'])
-    
-    # Load validation tests into test battery
-    test_battery = TestBattery(PATHS['TEST_SCRIPTS'], TESTSXLS)
-
-    # Run the validation tests in the browser
-    test_battery.validate(browser)
-    
-    # End the browser session    
+    if args.backend == 'concurrent':
+        from engine import ConcurrentEngine
+        browser = ConcurrentEngine(OC['URL'], PATHS['SCREENSHOTS'],
+                                   args.workers or ENGINE['CONCURRENCY'],
+                                   ENGINE['RATE'], ENGINE['BURST'],
+                                   ENGINE['RETRIES'], ENGINE['BACKOFF'])
+    elif args.workers and args.workers > 1:
+        from models import BrowserPool
+        browser = BrowserPool(OC['URL'], PATHS['SCREENSHOTS'], args.workers, backend)
+    else:
+        browser = backend(OC['URL'], PATHS['SCREENSHOTS'])
+    try:
+        browser.login(OC['USER'], OC['PWD'])
+        browser.set_study(OC['STUDY'])
+    except LoginError as e:
+        print e
+        browser.close()
+        sys.exit(1)
+
+    # Validation tests are loaded into the test battery
+    # while the first ones are already running, unless they are
+    # scheduled: then all are read first. Scripts that have not
+    # changed are not parsed again.
+    scheduler = create_scheduler(args)
+    test_battery = load_battery(args, lazy=scheduler is None)
+    order = None
+    if scheduler is not None:
+        order = test_battery.schedule(scheduler)
+        print_schedule(scheduler, order)
+
+    # Run the validation tests in the browser, reusing the results
+    # of tests that have not changed since an earlier run. Every
+    # outcome goes to the journal at once, so a crashed run can be resumed.
+    cache = ResultCache(PATHS['RESULTS'])
+    run = args.resume or new_run(args.shard)
+    journal = open_journal(run, args.resume is not None)
+    # Every run goes into the history, for diff and the trend in the overview
+    formats = args.export if 'sqlite' in args.export else args.export + ['sqlite']
+    try:
+        exporters = add_exporters(test_battery, formats, run,
+                                  shard=args.shard and "%d/%d" % args.shard,
+                                  resume=args.resume is not None)
+    except ValueError as e:
+        print e
+        sys.exit(1)
+    if args.force:
+        test_battery.validate(browser, offline=args.offline, journal=journal, order=order)
+    else:
+        test_battery.validate(browser, cache, args.max_age, args.offline, journal, order)
+    journal.close()
+    cache.save(test_battery.rules())
+    print "Reused %d results of earlier runs" % test_battery.summary()[1]['cached_tests']
+    if args.resume:
+        print "Resumed %d results from the journal" % journal.restored
+    if args.offline:
+        print_disagreements(test_battery)
+    cache.close()
+
+    # End the browser session
     browser.close()
-        
-    # Create PDF reports
-    test_battery.create_reports(PATHS['REPORTS'])
 
+    # Where the time went
+    import timings
+    phases = timings.per_phase(test_battery.spans())
+    for phase in sorted(phases):
+        print "%s: %s" % (phase, timings.describe(phases[phase]))
+
+    # Export and create PDF reports
+    finish(test_battery, exporters, not args.no_pdf, args.merged)
+
+
+def report(args):
+    """ Create the reports from the results stored by earlier runs """
+    test_battery = load_battery(args)
+    restore_results(test_battery, args.max_age)
+    # an export of earlier results is not a run of its own in the history
+    exporters = add_exporters(test_battery, args.export, new_run(), validated=False)
+    finish(test_battery, exporters, not args.no_pdf, args.merged)
+
+
+def summary(args):
+    """ Print the summary of the results stored by earlier runs """
+    test_battery = load_battery(args)
+    restore_results(test_battery, args.max_age)
+    print_summary(test_battery)
+
+
+def diff(args):
+    """ Print the tests that regressed, were fixed or are new since a run """
+    from history import History
+    if not os.path.exists(PATHS['HISTORY']):
+        print "No history yet in %s" % PATHS['HISTORY']
+        sys.exit(1)
+    history = History(PATHS['HISTORY'])
+    runs = history.runs()
+    new = args.to or history.latest(sharded=args.shards)
+    if new is None:
+        print "No run of all rules in the history yet (see --shards)"
+        sys.exit(1)
+    # a run of a shard is compared with the run of that shard before it
+    old = args.since or history.latest(before=new, shard=history.shard(new))
+    for run in (old, new):
+        if run not in runs:
+            if run is None:
+                print "There is no earlier run to compare with"
+            else:
+                print "No run %s in the history; the last runs are: %s" % (
+                        run, ", ".join(runs[-5:]))
+            sys.exit(1)
+    changes = history.diff(old, new)
+    history.close()
+    print "Changes in run %s since run %s:" % (new, old)
+    for kind in ('regressed', 'fixed', 'new'):
+        print "%s: %d" % (kind.capitalize(), len(changes[kind]))
+        for page, rule, test_id, outcome in changes[kind]:
+            print "    %s / %s / %s: %s" % (page, rule, test_id, outcome or "Undef")
+
+
+def shard(text):
+    """ Argument type of --shard """
+    from scheduler import parse_shard
+    try:
+        return parse_shard(text)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+
+
+def parse_args(argv):
+    """ Parse the command line; without a command, validate as before """
+    parser = argparse.ArgumentParser(description="Validation of OpenClinica rules")
+    commands = parser.add_subparsers(dest='command', help="what to do (default: validate)")
+
+    scripts = argparse.ArgumentParser(add_help=False)
+    scripts.add_argument('scripts', nargs='*',
+                         help="test scripts to use (default: TESTSXLS in settings.py)")
+    max_age = argparse.ArgumentParser(add_help=False)
+    max_age.add_argument('--max-age', type=float,
+                         help="only use results of earlier runs of at most this many hours old")
+    output = argparse.ArgumentParser(add_help=False)
+    output.add_argument('--export', nargs='+', default=[],
+                        choices=['jsonl', 'junit', 'sqlite'],
+                        help="also write the results as JSON lines or JUnit XML to the "
+                             "report folder, or add them to the HISTORY database "
+                             "(validate always does)")
+    output.add_argument('--no-pdf', action='store_true',
+                        help="do not create the PDF reports")
+    output.add_argument('--merged', action='store_true',
+                        help="create one PDF per page, with bookmarks and a table of "
+                             "contents, instead of one PDF per rule")
+    offline = argparse.ArgumentParser(add_help=False)
+    offline.add_argument('--offline', action='store_true',
+                         help="evaluate rule expressions locally first, list the tests "
+                              "that disagree with them and run their rules first "
+                              "(for rules with a Fires When column)")
+
+    command = commands.add_parser('load', parents=[scripts, offline],
+                                  help="read the test scripts, without running tests")
+    command.set_defaults(run=load)
+
+    command = commands.add_parser('validate', parents=[scripts, max_age, offline, output],
+                                  help="run the tests in OpenClinica and create the reports")
+    command.add_argument('--workers', type=int,
+                         help="number of browser sessions that run tests in parallel")
+    command.add_argument('--backend', choices=['selenium', 'http', 'concurrent'],
+                         default='selenium',
+                         help="run tests in Firefox, send the TestRule form directly, "
+                              "or send many forms at once (see ENGINE in settings.py)")
+    command.add_argument('--force', action='store_true',
+                         help="run all tests, also those with a result from an earlier run")
+    command.add_argument('--resume', metavar='RUN',
+                         help="continue a run that was interrupted: only run the tests "
+                              "that are not in its journal (see JOURNALS in settings.py)")
+    command.add_argument('--shard', type=shard, metavar='i/N',
+                         help="only run part i of N parts of about equal estimated time, "
+                              "to spread a run over machines with the same HISTORY")
+    command.add_argument('--shard-base', metavar='RUN',
+                         help="estimate the time of the shards from the history as of this "
+                              "run; give all shards the same RUN (default: the last run "
+                              "that was not a shard)")
+    command.add_argument('--in-order', action='store_true',
+                         help="run the rules in the order of the scripts, instead of the "
+                              "rules that failed or changed since the last run first")
+    command.set_defaults(run=validate)
+
+    command = commands.add_parser('report', parents=[scripts, max_age, output],
+                                  help="create the reports from the results of earlier runs")
+    command.set_defaults(run=report)
+
+    command = commands.add_parser('summary', parents=[scripts, max_age],
+                                  help="print the results of earlier runs per page")
+    command.set_defaults(run=summary)
+
+    command = commands.add_parser('diff', help="list the tests that regressed, were fixed "
+                                               "or are new since a run (see HISTORY in settings.py)")
+    command.add_argument('since', nargs='?', metavar='RUN',
+                         help="the run to compare with (default: the run before the other one)")
+    command.add_argument('--to', metavar='RUN',
+                         help="the run to compare (default: the last run of all rules)")
+    command.add_argument('--shards', action='store_true',
+                         help="by default, compare the last run even if it is a run of "
+                              "one shard (with the run of that shard before it)")
+    command.set_defaults(run=diff)
+
+    if not argv or argv[0] not in COMMANDS + ('-h', '--help'):
+        argv = ['validate'] + list(argv)
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    """ Validation of OpenClinica rules """
+    args = parse_args(sys.argv[1:])
+    args.run(args)